@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+"""
+Benchmark of the baseline index of BLsmooth.py
+
+Times the smoothing of whole antennas (no --max-memory) with the current code of
+scripts/BLsmooth.py against the previous per-baseline loop (one np.where scan,
+gather and scatter per baseline), and checks that both give the same result.
+
+The data are synthetic and held in memory, so that only the computation is
+timed: 60 stations, ANTENNA1 = 0, 20 and 40, one row per baseline and time
+slot, random baseline lengths. Every time is the best of a number of repeats.
+"""
+import argparse
+import logging
+import os
+import time
+import numpy as np
+
+script = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'scripts', 'BLsmooth.py')
+
+
+def load_blsmooth():
+    """
+    Return the functions of BLsmooth.py (its definitions, without running it)
+    """
+    with open(script) as f:
+        src = f.read()
+    namespace = {'__name__': 'BLsmooth'}
+    exec(compile(src[:src.index('opt = optparse')], script, 'exec'), namespace)
+    logging.getLogger().setLevel(logging.WARNING)
+    return namespace
+
+
+class MemoryTable(object):
+    """
+    The part of the pyrap table interface used by smooth_chunks(), on arrays
+    """
+    def __init__(self, cols):
+        self.cols = cols
+
+    def nrows(self):
+        return len(self.cols['ANTENNA2'])
+
+    def getcol(self, col, startrow=0, nrow=-1):
+        if nrow < 0:
+            nrow = self.nrows() - startrow
+        return self.cols[col][startrow:startrow+nrow].copy()
+
+
+def loop_per_baseline(gfilter, ant1, a_ant2, a_uvw, a_data, a_weights, a_flags,
+                      freq, timepersample, ionfactor=0.2, bscalefactor=0.5):
+    """
+    Smooth the rows of ant1 as BLsmooth.py did before the baseline index
+    """
+    for ant2 in set(a_ant2):
+        if ant1 == ant2: continue
+        idx = np.where(a_ant2 == ant2)
+        uvw = a_uvw[idx]
+        data = a_data[idx]
+        weights = a_weights[idx]
+        flags = a_flags[idx]
+        dist = np.mean(np.sqrt(uvw[:, 0]**2 + uvw[:, 1]**2 + uvw[:, 2]**2)) / 1.e3
+        stddev = ionfactor * (25.e3 / dist)**bscalefactor * (freq / 60.e6) / timepersample
+        if stddev < 0.5: continue
+        flags[np.isnan(data)] = True
+        weights[flags] = 0
+        data = np.nan_to_num(data*weights)
+        dataR = gfilter(np.real(data), stddev, axis=0)
+        dataI = gfilter(np.imag(data), stddev, axis=0)
+        weights = gfilter(weights, stddev, axis=0)
+        data = dataR + 1j*dataI
+        data[(weights != 0)] /= weights[(weights != 0)]
+        a_data[idx] = data
+        a_weights[idx] = weights
+    return a_data, a_weights
+
+
+def baseline_index(bl, ant1, table, a_uvw, freq, timepersample, ionfactor=0.2, bscalefactor=0.5):
+    """
+    Smooth the rows of ant1 with the current code of BLsmooth.py
+    """
+    bl_rows = bl['group_rows'](table.cols['ANTENNA2'])
+    dist = np.sqrt(np.sum(a_uvw**2, axis=1))
+    a_dist = dict((ant2, np.mean(dist[rows])) for ant2, rows in bl_rows.items())
+    sigmas = bl['get_sigmas'](ant1, a_dist, freq, timepersample, ionfactor, bscalefactor)
+    startrow, a_data, a_weights = list(bl['smooth_chunks'](table, ant1, bl_rows, sigmas, 'DATA'))[0]
+    return a_data, a_weights
+
+
+def main(ntimes, nchan, nstations=60, repeat=3, seed=0):
+    bl = load_blsmooth()
+    rng = np.random.RandomState(seed)
+    lengths = rng.uniform(50, 60000, nstations)
+    total_loop = total_index = 0.
+    for ant1 in (0, 20, 40):
+        a_ant2 = np.tile(np.arange(ant1, nstations), ntimes)
+        nrows = len(a_ant2)
+        cols = dict(ANTENNA2=a_ant2,
+                    UVW=lengths[a_ant2][:, None] * np.array([[0.6, 0.8, 0.]]),
+                    DATA=(rng.normal(size=(nrows, nchan, 4)) + 1j*rng.normal(size=(nrows, nchan, 4))).astype(np.complex64),
+                    WEIGHT_SPECTRUM=rng.random_sample((nrows, nchan, 4)).astype(np.float32),
+                    FLAG=rng.random_sample((nrows, nchan, 4)) < 0.05)
+
+        time_loop = time_index = np.inf
+        for i in range(repeat):
+            c = dict((col, values.copy()) for col, values in cols.items())
+            t0 = time.time()
+            data_loop, weights_loop = loop_per_baseline(bl['gfilter'], ant1, c['ANTENNA2'], c['UVW'], c['DATA'],
+                                                        c['WEIGHT_SPECTRUM'], c['FLAG'], 60e6, 4.)
+            t1 = time.time()
+            data_index, weights_index = baseline_index(bl, ant1, MemoryTable(cols), cols['UVW'], 60e6, 4.)
+            t2 = time.time()
+            time_loop = min(time_loop, t1 - t0)
+            time_index = min(time_index, t2 - t1)
+
+        equal = (np.array_equal(data_loop.view(np.uint8), data_index.view(np.uint8)) and
+                 np.array_equal(weights_loop, weights_index))
+        print('ant1 %2i: %7i rows, %2i baselines: np.where loop %.2f s, baseline index %.2f s, identical: %s'
+              % (ant1, nrows, nstations - ant1, time_loop, time_index, equal))
+        total_loop += time_loop
+        total_index += time_index
+    print('ntimes %i, nchan %i: np.where loop %.2f s, baseline index %.2f s'
+          % (ntimes, nchan, total_loop, total_index))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the baseline index of BLsmooth.py.')
+    parser.add_argument('--ntimes', type=int, nargs='+', default=[1500, 10000, 3000],
+                        help='Numbers of time slots (default: 1500 10000 3000)')
+    parser.add_argument('--nchan', type=int, nargs='+', default=[4, 1, 16],
+                        help='Numbers of channels, one per number of time slots (default: 4 1 16)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of repeats, the best time is taken (default: 3)')
+    args = parser.parse_args()
+
+    for ntimes, nchan in zip(args.ntimes, args.nchan):
+        main(ntimes, nchan, repeat=args.repeat)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""
+Check all MSs of a mapfile for a minimum fraction of unflagged data
+"""
+import os
+import sys
+import json
+import tempfile
+import multiprocessing
+from lofarpipe.support.data_map import DataMap
+from lofarpipe.support.data_map import DataProduct
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'scripts'))
+from check_unflagged_fraction import find_unflagged_fraction
+
+
+def plugin_main(args, **kwargs):
+    """
+    Checks all MSs of a mapfile in parallel for a minimum fraction of unflagged
+    data
+
+    The results are cached per MS, so that a rerun (e.g. after a crash) only
+    checks the MSs that have not been checked yet or have changed since.
+
+    Parameters
+    ----------
+    mapfile_in : str
+        Filename of datamap containing MS files
+    min_fraction : float, optional
+        Minimum fraction of unflagged data needed to keep an MS (default = 0.01)
+    ncpu : int, optional
+        Number of MSs to check in parallel (default = number of CPUs)
+    cache_dir : str, optional
+        Directory for the cached results (default = <mapfile_dir>/<filename>_cache)
+    mapfile_dir : str
+        Directory for output mapfiles
+    filename: str
+        Name of output mapfiles
+
+    Returns
+    -------
+    result : dict
+        Datamap filenames: 'flagged' with the MSs or "None" for MSs with too
+        little unflagged data and 'unflagged_fraction' with the fraction of
+        unflagged data of each MS
+
+    """
+    mapfile_in = kwargs['mapfile_in']
+    mapfile_dir = kwargs['mapfile_dir']
+    filename = kwargs['filename']
+    min_fraction = float(kwargs.get('min_fraction', 0.01))
+    ncpu = int(kwargs.get('ncpu', multiprocessing.cpu_count()))
+    cache_dir = kwargs.get('cache_dir', os.path.join(mapfile_dir, filename + '_cache'))
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    map_in = DataMap.load(mapfile_in)
+    tasks = [(item.file, cache_dir) for item in map_in if not item.skip]
+    if ncpu > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(ncpu, len(tasks)))
+        fractions = pool.map(check_ms, tasks)
+        pool.close()
+        pool.join()
+    else:
+        fractions = [check_ms(task) for task in tasks]
+    fractions = dict(zip([ms for (ms, cache) in tasks], fractions))
+
+    flagged_map = DataMap([])
+    fraction_map = DataMap([])
+    for item in map_in:
+        if item.skip:
+            flagged_map.data.append(DataProduct(item.host, item.file, item.skip))
+            fraction_map.data.append(DataProduct(item.host, 'None', item.skip))
+            continue
+        unflagged_fraction = fractions[item.file]
+        if unflagged_fraction < min_fraction:
+            print('checkUnflaggedFraction: Unflagged fraction of {0} is: {1}, '
+                  'removing file.'.format(os.path.basename(item.file), str(unflagged_fraction)))
+            flagged_map.data.append(DataProduct(item.host, 'None', item.skip))
+        else:
+            flagged_map.data.append(DataProduct(item.host, item.file, item.skip))
+        fraction_map.data.append(DataProduct(item.host, str(unflagged_fraction), item.skip))
+
+    flaggedid = os.path.join(mapfile_dir, filename)
+    flagged_map.save(flaggedid)
+    fractionid = os.path.join(mapfile_dir, filename + '_fraction')
+    fraction_map.save(fractionid)
+    result = {'flagged': flaggedid, 'unflagged_fraction': fractionid}
+
+    return result
+
+
+def ms_mtime(ms):
+    """
+    Returns the time of the last modification of any file of an MS (the flags
+    are stored in the column files, not in table.dat)
+    """
+    return max([os.path.getmtime(os.path.join(ms, f)) for f in os.listdir(ms)] +
+               [os.path.getmtime(ms)])
+
+
+def check_ms(task):
+    """
+    Returns the unflagged fraction of an MS, from the cache if possible
+
+    task is a tuple (name of the MS, cache directory)
+    """
+    ms, cache_dir = task
+    ms = ms.rstrip('/')
+    mtime = ms_mtime(ms)
+    cache_file = os.path.join(cache_dir, os.path.basename(ms) + '.json')
+    try:
+        with open(cache_file, 'r') as f:
+            entry = json.load(f)
+        if entry['path'] == os.path.abspath(ms) and entry['mtime'] == mtime:
+            print('checkUnflaggedFraction: Using cached result for ' + ms)
+            return entry['unflagged_fraction']
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    print('checkUnflaggedFraction: Reading ' + ms)
+    unflagged_fraction = find_unflagged_fraction(ms)
+
+    # write to a temporary file first, so that a crash never leaves a partial
+    # cache file
+    entry = {'path': os.path.abspath(ms), 'mtime': mtime,
+             'unflagged_fraction': unflagged_fraction}
+    try:
+        fd, tmpname = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.rename(tmpname, cache_file)
+    except (IOError, OSError):
+        pass
+    return unflagged_fraction
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+Make the sky models of all bands from one read of the FITS model images
+"""
+import os
+import sys
+from lofarpipe.support.data_map import DataMap
+from lofarpipe.support.data_map import DataProduct
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'scripts'))
+from fits2sky import get_band, make_skymodels
+
+
+def plugin_main(args, **kwargs):
+    """
+    Makes a makesourcedb sky model for every band of a mapfile from WSClean
+    FITS model images
+
+    All bands use the same model and mask images, so these are read only once
+    (see fits2sky.make_skymodels()). A band whose MS cannot be read or whose
+    sky model cannot be made or written is marked as skipped in the output
+    mapfile, the other bands go on (as with error_tolerance for a step run per
+    band).
+    As a plugin this runs on the head node, which must see the MSs, the images
+    and skymodel_dir (i.e., a shared filesystem, as the parsets expect).
+
+    Parameters
+    ----------
+    mapfile_in : str
+        Filename of datamap containing the MSs of each band (e.g., the groupmap)
+    mapfile_models : str
+        Filename of datamap containing the list of model images (single item)
+    mapfile_masks : str
+        Filename of datamap containing the list of mask images (single item)
+    skymodel_dir : str
+        Directory for the sky models
+    min_flux_jy : float, optional
+        Minimum value of flux in Jy of a source to include in the sky models
+        (default = 0.005)
+    interp : str, optional
+        Interpolation method (see fits2sky.main(), default = 'linear')
+    mapfile_dir : str
+        Directory for output mapfile
+    filename: str
+        Name of output mapfile
+
+    Returns
+    -------
+    result : dict
+        Datamap filename with the sky model of each band
+
+    """
+    mapfile_in = kwargs['mapfile_in']
+    mapfile_models = kwargs['mapfile_models']
+    mapfile_masks = kwargs['mapfile_masks']
+    skymodel_dir = kwargs['skymodel_dir']
+    min_flux_jy = float(kwargs.get('min_flux_jy', 0.005))
+    interp = kwargs.get('interp', 'linear')
+    mapfile_dir = kwargs['mapfile_dir']
+    filename = kwargs['filename']
+
+    fits_models = [f.strip(' \'\"') for f in DataMap.load(mapfile_models)[0].file.strip('[]').split(',')]
+    fits_masks = [f.strip(' \'\"') for f in DataMap.load(mapfile_masks)[0].file.strip('[]').split(',')]
+
+    if not os.path.isdir(skymodel_dir):
+        os.makedirs(skymodel_dir)
+    map_in = DataMap.load(mapfile_in)
+    map_out = DataMap([])
+    bands = []
+    skymodels = []
+    for item in map_in:
+        ms_file = item.file.strip('[]').split(',')[0].strip(' \'\"')
+        skymodel = os.path.join(skymodel_dir, '{0}.{1}'.format(os.path.basename(ms_file),
+                                                                os.path.splitext(filename)[0]))
+        map_out.data.append(DataProduct(item.host, skymodel, item.skip))
+        if not item.skip:
+            try:
+                bands.append(get_band(ms_file))
+            except Exception as e:
+                print('fitsToSkymodels: Skipping {0}, cannot read {1}: {2}'.format(skymodel,
+                                                                                 ms_file, e))
+                map_out.data[-1].skip = True
+                continue
+            skymodels.append(skymodel)
+
+    print('fitsToSkymodels: Making {0} sky models from {1} model images'.format(len(skymodels),
+                                                                             len(fits_models)))
+    failed = make_skymodels(fits_models, fits_masks, bands, skymodels, min_flux_jy, interp)
+    for item in map_out.data:
+        if item.file in failed:
+            print('fitsToSkymodels: Skipping {0}, cannot make it: {1}'.format(item.file,
+                                                                           failed[item.file]))
+            item.skip = True
+    if all(item.skip for item in map_out.data) and not all(item.skip for item in map_in.data):
+        raise ValueError('fitsToSkymodels: No sky model could be made.')
+
+    fileid = os.path.join(mapfile_dir, filename)
+    map_out.save(fileid)
+    result = {'mapfile': fileid}
+
+    return result
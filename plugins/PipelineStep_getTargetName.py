@@ -3,8 +3,11 @@
 Identify fully flagged antennas
 """
 
+import os
+import sys
 from lofarpipe.support.data_map import DataMap, DataProduct
-import pyrap.tables
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'scripts'))
+from ms_metadata import get_ms_metadata
 
 def find_flagged_antennas(ms_file):
     
@@ -35,8 +38,7 @@ def plugin_main(args, **kwargs):
     mslist         = [data[i].file for i in xrange(len(data))]
     msfile         = mslist[0]
     
-    observationTable = pyrap.tables.table(msfile + '/OBSERVATION')
-    targetName       = observationTable.getcol('LOFAR_TARGET')['array'][0]
+    targetName       = get_ms_metadata(msfile)['target_name']
         
     ## return results
     result = {'targetName':targetName}
@@ -5,13 +5,16 @@ Identify fully flagged antennas
 
 from lofarpipe.support.data_map import DataMap, DataProduct
 import os
+import sys
 import multiprocessing
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'scripts'))
+import check_unflagged_fraction
 
 def find_flagged_antennas(ms_file):
     
    print 'Reading ' + str(ms_file)
-   outputs = os.popen('DPPP msin=' + ms_file + ' msout=. steps=[count] count.type=counter count.warnperc=100 | grep NOTE').readlines()
-   flaggedants = [ output.split('(')[-1].rstrip(')\n') for output in outputs if 'station' in output ]
+   statistics  = check_unflagged_fraction.find_flag_statistics(ms_file)
+   flaggedants = check_unflagged_fraction.find_flagged_antennas(statistics)
    return flaggedants
 
 def plugin_main(args, **kwargs):
@@ -1,6 +1,8 @@
 import os
-import casacore.tables as pt
+import sys
 from lofarpipe.support.data_map import DataMap, DataProduct
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'scripts'))
+from ms_metadata import get_ms_metadata
 
 
 def get_distributed_indices(start, end, n):
@@ -24,6 +26,8 @@ def plugin_main(args, **kwargs):
         Name of output mapfile
     num: int, optional
         Number of frequencies in output mapfile
+    cache_dir : str, optional
+        Directory of the MS metadata cache (see ms_metadata.get_ms_metadata())
 
     Returns
     -------
@@ -38,6 +42,7 @@ def plugin_main(args, **kwargs):
         num = int(kwargs['num'])
     else:
         num = 6
+    cache_dir = kwargs.get('cache_dir', None)
     fileid = os.path.join(mapfile_dir, filename)
 
     map_in = DataMap.load(mapfile_in)
@@ -63,9 +68,7 @@ def plugin_main(args, **kwargs):
             ms_file = item.file
 
         # Get the frequency info from the MS file
-        sw = pt.table(ms_file+'::SPECTRAL_WINDOW', ack=False)
-        freq = int(sw.col('REF_FREQUENCY')[0])
-        sw.close()
+        freq = int(get_ms_metadata(ms_file, cache_dir)['ref_freq'])
         if freq in freq_groups:
             freq_groups[freq].append(item.file)
         else:
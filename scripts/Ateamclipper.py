@@ -5,60 +5,154 @@
 # W.Williams 2014/11/03  fix - statistics per correlation
 # A.Drabent 2019/07/24   write fraction of flagged data into output file (for prefactor3)
 
+import argparse
+import tempfile
 import numpy
 import pyrap.tables as pt
 import os, sys
-
-msname  = str(sys.argv[1])
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from ms_metadata import get_ms_metadata
 
 cliplevelhba = 5.0
 cliplevellba = 50.0
 
-t = pt.table(msname, readonly=False)
-data = t.getcol('MODEL_DATA')
-flag = t.getcol('FLAG')
-freq_tab= pt.table(msname + '/SPECTRAL_WINDOW')
-freq    = freq_tab.getcol('REF_FREQUENCY')
-
-if freq[0] > 100e6:
- cliplevel = cliplevelhba
-if freq[0] < 100e6:
- cliplevel = cliplevellba
-
-
-print('------------------------------')
-print('SB Frequency [MHz]', freq[0]/1e6)
-for chan in range(0,numpy.size(data[0,:,0])):
-  print('chan %i : %.5f%% input XX flagged' %( chan, 100.*numpy.sum(flag[:,chan,0] == True)/numpy.size(flag[:,chan,0]) ))
-  print('chan %i : %.5f%% input YY flagged' %( chan, 100.*numpy.sum(flag[:,chan,3] == True)/numpy.size(flag[:,chan,3]) ))
-input_flags_xx = 100. * numpy.sum(flag[:,:,0] == True)/numpy.size(flag[:,:,0])
-input_flags_yy = 100. * numpy.sum(flag[:,:,3] == True)/numpy.size(flag[:,:,3])
-print('Total : %.5f%% input XX flagged' %(   input_flags_xx ))
-print('Total : %.5f%% input YY flagged' %(   input_flags_yy ))
-print('')
-print('Cliplevel used [Jy]', cliplevel)
-print('\n\n')
-
-for pol in range(0,numpy.size(data[0,0,:])):
- for chan in range(0,numpy.size(data[0,:,0])):
-  print('Doing polarization,chan', pol, chan)
-  idx = numpy.where(abs(data[:,chan,pol]) > cliplevel)
-  flag[idx,chan,0] = True
-  flag[idx,chan,1] = True
-  flag[idx,chan,2] = True
-  flag[idx,chan,3] = True 
-
-print('')
-for chan in range(0,numpy.size(data[0,:,0])):
-  print('chan %i : %.5f%% output XX flagged' %( chan, 100.*numpy.sum(flag[:,chan,0] == True)/numpy.size(flag[:,chan,0]) ))
-  print('chan %i : %.5f%% output YY flagged' %( chan, 100.*numpy.sum(flag[:,chan,3] == True)/numpy.size(flag[:,chan,3]) ))
-output_flags_xx = 100. * numpy.sum(flag[:,:,0] == True)/numpy.size(flag[:,:,0])
-output_flags_yy = 100. * numpy.sum(flag[:,:,3] == True)/numpy.size(flag[:,:,3])
-print('Total : %.5f%% input XX flagged' %(   output_flags_xx ))
-print('Total : %.5f%% input YY flagged' %(   output_flags_yy ))
-print('')
-t.putcol('FLAG', flag)
-t.close()
-freq_tab.close()
-
-os.system('echo ' + str(freq[0]) + ' ' + str(output_flags_xx - input_flags_xx) + ' ' + str(output_flags_yy - input_flags_yy) + ' >> Ateamclipper.txt')
\ No newline at end of file
+
+def clip_chunk(data, flag, cliplevel):
+    """
+    Flag all correlations of the visibilities for which the model of any
+    correlation exceeds the clip level
+
+    Parameters
+    ----------
+    data : array
+        MODEL_DATA of a chunk of rows (row, channel, correlation)
+    flag : array
+        FLAG of the same rows, updated in place
+    cliplevel : float
+        Clip level in Jy
+
+    Returns
+    -------
+    clipped : bool
+        True if any visibility was clipped
+    """
+    clip = numpy.any(numpy.abs(data) > cliplevel, axis=2)
+    flag |= clip[:, :, numpy.newaxis]
+    return bool(numpy.any(clip))
+
+
+def write_record(record_dir, msname, freq, clipped):
+    """
+    Write the clipping statistics of one subband to its own file
+
+    The record is written to a temporary file first and then renamed, so that
+    parallel jobs never interfere and no partial records are left behind.
+
+    Parameters
+    ----------
+    record_dir : str
+        Directory for the records (one file per MS)
+    msname : str
+        Name of the MS
+    freq : float
+        Reference frequency of the MS
+    clipped : array
+        Additionally flagged percentage of the data per channel and correlation
+    """
+    try:
+        os.makedirs(record_dir)
+    except OSError:
+        # created by a parallel job
+        if not os.path.isdir(record_dir):
+            raise
+    record = os.path.join(record_dir, os.path.basename(msname.rstrip('/')) + '.npz')
+    fd, tmpname = tempfile.mkstemp(dir=record_dir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        numpy.savez(f, msname=msname, freq=freq, clipped=clipped)
+    os.rename(tmpname, record)
+
+
+def main(msname, chunksize=100000, record_dir='Ateamclipper'):
+    """
+    Flag the data for which the model of the A-team is above the clip level
+
+    The MS is processed in chunks of rows, the flag statistics per channel and
+    correlation before and after clipping are counted in the same pass.
+
+    Parameters
+    ----------
+    msname : str
+        Name of the MS, with the A-team model in MODEL_DATA
+    chunksize : int, optional
+        Number of rows to process at once
+    record_dir : str, optional
+        Directory for the clipping statistics of each subband (see
+        merge_Ateamclipper.py)
+
+    Returns
+    -------
+    result : tuple
+        Reference frequency of the MS and the additionally flagged percentage
+        of the XX and YY data
+    """
+    freq = get_ms_metadata(msname)['ref_freq']
+    if freq > 100e6:
+        cliplevel = cliplevelhba
+    else:
+        cliplevel = cliplevellba
+
+    t = pt.table(msname, readonly=False)
+    nrows = t.nrows()
+    input_flags = 0.
+    output_flags = 0.
+    for startrow in range(0, nrows, chunksize):
+        nrow = min(chunksize, nrows - startrow)
+        data = t.getcol('MODEL_DATA', startrow, nrow)
+        flag = t.getcol('FLAG', startrow, nrow)
+        input_flags = input_flags + numpy.sum(flag, axis=0)
+        if clip_chunk(data, flag, cliplevel):
+            t.putcol('FLAG', flag, startrow, nrow)
+        output_flags = output_flags + numpy.sum(flag, axis=0)
+    t.close()
+
+    # percentage of flagged data per channel and correlation
+    nchan = input_flags.shape[0]
+    input_flags_xx = 100. * numpy.sum(input_flags[:,0]) / (nrows * nchan)
+    input_flags_yy = 100. * numpy.sum(input_flags[:,3]) / (nrows * nchan)
+    output_flags_xx = 100. * numpy.sum(output_flags[:,0]) / (nrows * nchan)
+    output_flags_yy = 100. * numpy.sum(output_flags[:,3]) / (nrows * nchan)
+    input_flags = 100. * input_flags / nrows
+    output_flags = 100. * output_flags / nrows
+
+    print('------------------------------')
+    print('SB Frequency [MHz]', freq/1e6)
+    for chan in range(nchan):
+        print('chan %i : %.5f%% input XX flagged' %( chan, input_flags[chan,0] ))
+        print('chan %i : %.5f%% input YY flagged' %( chan, input_flags[chan,3] ))
+    print('Total : %.5f%% input XX flagged' %(   input_flags_xx ))
+    print('Total : %.5f%% input YY flagged' %(   input_flags_yy ))
+    print('')
+    print('Cliplevel used [Jy]', cliplevel)
+    print('\n\n')
+    print('')
+    for chan in range(nchan):
+        print('chan %i : %.5f%% output XX flagged' %( chan, output_flags[chan,0] ))
+        print('chan %i : %.5f%% output YY flagged' %( chan, output_flags[chan,3] ))
+    print('Total : %.5f%% output XX flagged' %(   output_flags_xx ))
+    print('Total : %.5f%% output YY flagged' %(   output_flags_yy ))
+    print('')
+
+    write_record(record_dir, msname, freq, output_flags - input_flags)
+    return (freq, float(output_flags_xx - input_flags_xx), float(output_flags_yy - input_flags_yy))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Flag data that are affected by the A-team (based on the model in MODEL_DATA).')
+    parser.add_argument('msname', type=str, help='Name of the MS')
+    parser.add_argument('--chunksize', type=int, default=100000,
+                        help='Number of rows to process at once (default: 100000)')
+    parser.add_argument('--record_dir', type=str, default='Ateamclipper',
+                        help='Directory for the clipping statistics of each subband (default: Ateamclipper)')
+    args = parser.parse_args()
+
+    main(args.msname, args.chunksize, args.record_dir)
@@ -23,23 +23,373 @@
 
 import os, sys, time
 import optparse, itertools
-import logging
+import logging, multiprocessing, threading, traceback
 import numpy as np
+try:
+    import queue as thread_queue
+except ImportError:
+    import Queue as thread_queue
 from scipy.ndimage.filters import gaussian_filter1d as gfilter
 import pyrap.tables as pt
 logging.basicConfig(level=logging.DEBUG)
 
-def addcol(ms, incol, outcol):
+# gfilter cuts the Gaussian kernel at this many sigmas (scipy default)
+truncate = 4.
+# from this sigma (in samples) on, stacks of baselines are convolved by FFT if allowed
+fft_min_sigma = 15.
+
+def addcol(ms, incol, outcol, copy=True):
     if outcol not in ms.colnames():
         logging.info('Adding column: '+outcol)
         coldmi = ms.getdminfo(incol)
         coldmi['NAME'] = outcol
         ms.addcols(pt.makecoldesc(outcol, ms.getcoldesc(incol)), coldmi)
-    if outcol != incol:
+    if outcol != incol and copy:
         # copy columns val
         logging.info('Set '+outcol+'='+incol)
         pt.taql("update $ms set "+outcol+"="+incol)
 
+def read_metadata(ms, keep_times=False, nrow=1000000):
+    """
+    Read in a single pass, nrow rows at a time, the row numbers and ANTENNA2 of the
+    rows of every antenna1 and the mean UVW length of every baseline, and check that
+    the MS is time-sorted. Nothing else is kept for every row. If the MS is not
+    time-sorted and keep_times, the rows of every antenna are put in time order.
+    Return (ant_rows, ant_ant2, ant_dist, time_sorted), the first three are dicts
+    ant1 -> row numbers, ant1 -> ANTENNA2 of these rows and ant1 -> {ant2: mean
+    UVW length}.
+    """
+    nrows = ms.nrows()
+    rowtype = np.int32 if nrows < 2**31 else np.int64
+    parts = {}
+    dist_sums = {}
+    time_sorted = True
+    last = -np.inf
+    for startrow in range(0, nrows, nrow):
+        n = min(nrow, nrows - startrow)
+        times = ms.getcol('TIME_CENTROID', startrow, n)
+        if time_sorted and (times[0] < last or np.any(times[1:] < times[:-1])):
+            time_sorted = False
+        last = times[-1]
+        uvw = ms.getcol('UVW', startrow, n)
+        dist = np.sqrt(uvw[:, 0]**2 + uvw[:, 1]**2 + uvw[:, 2]**2)
+        ant1s = ms.getcol('ANTENNA1', startrow, n)
+        ant2s = ms.getcol('ANTENNA2', startrow, n)
+        for ant1, idx in group_rows(ant1s).items():
+            parts.setdefault(ant1, []).append(((startrow + idx).astype(rowtype), ant2s[idx],
+                                               times[idx] if keep_times else None))
+        # sum and number of the UVW lengths of every baseline
+        baselines, bl_idx = np.unique(ant1s.astype(np.int64) * 65536 + ant2s, return_inverse=True)
+        for bl, bl_sum, bl_count in zip(baselines, np.bincount(bl_idx, dist), np.bincount(bl_idx)):
+            ant_sums = dist_sums.setdefault(int(bl // 65536), {})
+            ant2 = int(bl % 65536)
+            old_sum, old_count = ant_sums.get(ant2, (0., 0))
+            ant_sums[ant2] = (old_sum + bl_sum, old_count + bl_count)
+
+    ant_rows = {}
+    ant_ant2 = {}
+    for ant1 in sorted(parts.keys()):
+        ant_parts = parts.pop(ant1)
+        ant_rows[ant1] = np.concatenate([rows for rows, ant2s, times in ant_parts])
+        ant_ant2[ant1] = np.concatenate([ant2s for rows, ant2s, times in ant_parts])
+        if keep_times and not time_sorted:
+            order = np.argsort(np.concatenate([times for rows, ant2s, times in ant_parts]), kind='mergesort')
+            ant_rows[ant1] = ant_rows[ant1][order]
+            ant_ant2[ant1] = ant_ant2[ant1][order]
+    ant_dist = dict((ant1, dict((ant2, bl_sum / bl_count) for ant2, (bl_sum, bl_count) in ant_sums.items()))
+                    for ant1, ant_sums in dist_sums.items())
+    return ant_rows, ant_ant2, ant_dist, time_sorted
+
+def group_rows(keys):
+    """
+    Return a dict key -> positions in keys of all entries with that key, in their
+    original order, built with a single stable argsort.
+    """
+    order = np.argsort(keys, kind='mergesort')
+    values, starts = np.unique(keys[order], return_index=True)
+    bounds = np.append(starts, len(order))
+    return dict((value, order[bounds[i]:bounds[i+1]]) for i, value in enumerate(values))
+
+def get_sigmas(ant1, a_dist, freq, timepersample, ionfactor, bscalefactor):
+    """
+    Return a dict ant2 -> sigma of the Gaussian kernel (in samples) for all baselines
+    of ant1 that have to be smoothed, a_dist is a dict ant2 -> mean UVW length.
+    """
+    sigmas = {}
+    for ant2 in sorted(a_dist.keys()):
+        if ant1 == ant2: continue # skip autocorr
+
+        # compute the FWHM
+        dist = a_dist[ant2] / 1.e3
+        if np.isnan(dist): continue # fix for missing anstennas
+
+        stddev = ionfactor * (25.e3 / dist)**bscalefactor * (freq / 60.e6) # in sec
+        stddev = stddev/timepersample # in samples
+        logging.debug("%s - %s: dist = %.1f km: sigma=%.2f samples." % (ant1, ant2, dist, stddev))
+
+        if stddev == 0: continue # fix for flagged antennas
+        if stddev < 0.5: continue # avoid very small smoothing
+
+        sigmas[ant2] = stddev
+    return sigmas
+
+def bin_sigmas(sigmas, tolerance):
+    """
+    Round the sigmas to logarithmic bins of relative width tolerance, so that
+    baselines of similar length can be smoothed together.
+    """
+    step = np.log1p(tolerance)
+    return dict((ant2, np.exp(step * np.round(np.log(stddev) / step))) for ant2, stddev in sigmas.items())
+
+def fft_gfilter(x, stddev, output):
+    """
+    Same as gfilter(x, stddev, axis=1) for a stack of baselines (baseline, time,
+    channel, correlation), computed by FFT one channel at a time.
+    """
+    nsamples = x.shape[1]
+    radius = int(truncate * stddev + 0.5)
+    kernel = np.exp(-0.5 * np.arange(-radius, radius+1)**2 / stddev**2)
+    kernel /= kernel.sum()
+    nfft = 2**int(np.ceil(np.log2(nsamples + 4*radius)))
+    if np.iscomplexobj(x):
+        fft, ifft = np.fft.fft, np.fft.ifft
+    else:
+        fft, ifft = np.fft.rfft, np.fft.irfft
+    fkernel = fft(kernel, nfft)[:, np.newaxis]
+    for chan in range(x.shape[2]):
+        # mode 'symmetric' of np.pad is mode 'reflect' of gfilter
+        padded = np.pad(x[:, :, chan], ((0, 0), (radius, radius), (0, 0)), mode='symmetric')
+        output[:, :, chan] = ifft(fft(padded, nfft, axis=1) * fkernel, nfft, axis=1)[:, 2*radius:2*radius+nsamples]
+    return output
+
+def smear(x, stddev, axis=0, output=None, fft=False):
+    """
+    Gaussian filter of real or complex x along axis. With fft, stacks of baselines
+    (axis=1) with a long kernel are convolved by FFT.
+    """
+    if output is None:
+        output = np.empty_like(x)
+    if fft and axis == 1 and stddev >= fft_min_sigma and int(truncate * stddev + 0.5) < x.shape[1]:
+        fft_gfilter(x, stddev, output)
+    elif np.iscomplexobj(x):
+        gfilter(x.real, stddev, axis=axis, output=output.real, truncate=truncate)
+        gfilter(x.imag, stddev, axis=axis, output=output.imag, truncate=truncate)
+    else:
+        gfilter(x, stddev, axis=axis, output=output, truncate=truncate)
+    return output
+
+def smooth_baseline(data, weights, flags, stddev, onlyamp=False, axis=0, fft=False):
+    """
+    Smooth in place the visibilities of one baseline along the time axis, or of a
+    stack of baselines with time along axis=1.
+    """
+    flags[ np.isnan(data) ] = True # flag NaNs
+    weights[flags] = 0 # set weight of flagged data to 0
+
+    # Multiply every element of the data by the weights, convolve both the scaled data and the weights, and then
+    # divide the convolved data by the convolved weights (translating flagged data into weight=0). That's basically the equivalent of a
+    # running weighted average with a Gaussian window function.
+
+    # set bad data to 0 so nans do not propagate
+    data *= weights
+    np.nan_to_num(data, copy=False)
+
+    # smear weighted data and weights
+    if onlyamp:
+        dataAMP = smear(np.abs(data), stddev, axis, fft=fft)
+        dataPH = np.angle(data)
+    else:
+        smear(data, stddev, axis, output=data, fft=fft)
+
+    smear(weights, stddev, axis, output=weights, fft=fft)
+
+    # re-create data
+    if onlyamp:
+        data[:] = dataAMP * ( np.cos(dataPH) + 1j*np.sin(dataPH) )
+    data[(weights != 0)] /= weights[(weights != 0)] # avoid divbyzero
+
+class RowBuffer(object):
+    """
+    Keep the original values of a sliding range of rows of a table.
+
+    Rows that are still needed by the next chunk are kept in memory, so that
+    rows which were already overwritten on disk are never read back and every
+    row is read only once.
+    """
+    def __init__(self, table, cols):
+        self.table = table
+        self.cols = cols
+        self.lo = 0
+        self.hi = 0
+        self.values = {}
+
+    def get(self, lo, hi):
+        """
+        Return a dict col -> values of rows [lo, hi). Neither bound may decrease
+        between two calls.
+        """
+        for col in self.cols:
+            if lo >= self.hi:
+                self.values[col] = self.table.getcol(col, lo, hi-lo)
+            else:
+                kept = self.values[col][lo-self.lo:]
+                if hi > self.hi:
+                    kept = np.concatenate([kept, self.table.getcol(col, self.hi, hi-self.hi)])
+                self.values[col] = kept
+        self.lo, self.hi = lo, max(hi, self.hi)
+        return self.values
+
+def smooth_chunks(ms_ant1, ant1, bl_rows, sigmas, datacol, onlyamp=False, max_rows=0, fft=False):
+    """
+    Smooth all baselines of ant1 in blocks of rows, yield (startrow, data, weights) for each block.
+
+    Each block is read together with the truncate*sigma neighbouring samples of every
+    baseline on both sides, so that the Gaussian window is always complete and the
+    result of the block interior is identical to the one obtained smoothing whole
+    baselines. With max_rows = 0 all rows of ant1 are done in one block.
+
+    The samples of the smoothed baselines are gathered once per block into a buffer
+    where each baseline is a contiguous slice, smoothed in place there and scattered
+    back once. Baselines with the same sigma and number of samples are put next to
+    each other and smoothed with one filter call on the stack (by FFT for long
+    kernels, if fft).
+    """
+    nrows = sum(len(rows) for rows in bl_rows.values())
+    radius = dict((ant2, int(truncate * stddev + 0.5)) for ant2, stddev in sigmas.items())
+
+    chunk_rows = nrows
+    if max_rows > 0 and len(radius) > 0:
+        nbl = len(bl_rows)
+        overlap_rows = max(radius.values()) * nbl
+        chunk_rows = max(max_rows - 2*overlap_rows, nbl)
+        if chunk_rows == nbl:
+            logging.warning('Memory budget too small for antenna %s, using one time slot per chunk.' % ant1)
+        logging.debug('Antenna %s: smoothing %i rows in chunks of %i rows.' % (ant1, nrows, chunk_rows))
+
+    buf = RowBuffer(ms_ant1, [datacol, 'WEIGHT_SPECTRUM', 'FLAG'])
+    for r0 in range(0, nrows, chunk_rows):
+        r1 = min(r0 + chunk_rows, nrows)
+
+        # find for each baseline the samples of this block and the ones needed around them
+        samples = {}
+        lo, hi = r0, r1
+        for ant2, stddev in sigmas.items():
+            rows = bl_rows[ant2]
+            k0, k1 = np.searchsorted(rows, [r0, r1])
+            j0 = max(k0 - radius[ant2], 0)
+            j1 = min(k1 + radius[ant2], len(rows))
+            # keep the samples before this block also if the baseline has a gap here,
+            # the next blocks may still need them
+            if j0 < len(rows): lo = min(lo, rows[j0])
+            if k0 == k1: continue
+            samples[ant2] = (k0, k1, j0, j1)
+            hi = max(hi, rows[j1-1] + 1)
+
+        values = buf.get(lo, hi)
+        a_data = values[datacol][r0-lo:r1-lo].copy()
+        a_weights = values['WEIGHT_SPECTRUM'][r0-lo:r1-lo].copy()
+
+        if len(samples) > 0:
+            # reorder the block by baseline, and collect the stacks (start, nbl, nsamples, sigma)
+            gather, scatter, interior, stacks = [], [], [], []
+            start = 0
+            for ant2 in sorted(samples, key=lambda ant2: (sigmas[ant2], samples[ant2][3] - samples[ant2][2], ant2)):
+                k0, k1, j0, j1 = samples[ant2]
+                rows = bl_rows[ant2]
+                gather.append(rows[j0:j1] - lo)
+                scatter.append(rows[k0:k1] - r0)
+                interior.append(np.arange(start + k0 - j0, start + k1 - j0))
+                if len(stacks) > 0 and stacks[-1][2:] == (j1 - j0, sigmas[ant2]):
+                    stacks[-1] = (stacks[-1][0], stacks[-1][1] + 1) + stacks[-1][2:]
+                else:
+                    stacks.append((start, 1, j1 - j0, sigmas[ant2]))
+                start += j1 - j0
+            gather = np.concatenate(gather)
+            data = values[datacol][gather]
+            weights = values['WEIGHT_SPECTRUM'][gather]
+            flags = values['FLAG'][gather]
+
+            for start, nbl, nsamples, stddev in stacks:
+                stop = start + nbl * nsamples
+                shape = (nbl, nsamples) + data.shape[1:]
+                smooth_baseline(data[start:stop].reshape(shape), weights[start:stop].reshape(shape),
+                                flags[start:stop].reshape(shape), stddev, onlyamp, axis=1, fft=fft)
+
+            scatter = np.concatenate(scatter)
+            interior = np.concatenate(interior)
+            a_data[scatter] = data[interior]
+            a_weights[scatter] = weights[interior]
+
+        yield r0, a_data, a_weights
+
+def smooth_antenna(ms_ant1, ant1, a_ant2, a_dist, freq, timepersample, options, max_rows=0):
+    """
+    Smooth the rows ms_ant1 of ant1 (in time order) chunk by chunk, yield (startrow, data, weights).
+    a_ant2 is ANTENNA2 of these rows, a_dist the mean UVW length of every baseline.
+    """
+    logging.debug('Working on antenna: %s' % ant1)
+    bl_rows = group_rows(a_ant2)
+    sigmas = get_sigmas(ant1, a_dist, freq, timepersample, options.ionfactor, options.bscalefactor)
+    if options.sigma_tolerance > 0:
+        sigmas = bin_sigmas(sigmas, options.sigma_tolerance)
+
+    # without the pre-copy the input column is read and every row of outcol is
+    # written, the baselines that are not smoothed as they are
+    datacol = options.incol if options.lazy_copy else options.outcol
+    for chunk in smooth_chunks(ms_ant1, ant1, bl_rows, sigmas, datacol, options.onlyamp, max_rows,
+                               fft=options.sigma_tolerance > 0):
+        yield chunk
+
+def write_chunk(ms_ant1, startrow, a_data, a_weights, outcol, weight=False):
+    #logging.info('Writing %s column.' % outcol)
+    ms_ant1.putcol(outcol, a_data, startrow, len(a_data))
+
+    if weight:
+        #logging.warning('Writing WEIGHT_SPECTRUM column.')
+        ms_ant1.putcol('WEIGHT_SPECTRUM', a_weights, startrow, len(a_weights))
+
+def forward_results(queue, received):
+    """
+    Move the chunks of the workers to a queue of this process, in a thread: a
+    worker killed while sending a chunk leaves a partial message behind, and
+    reading it blocks forever.
+    """
+    while True:
+        received.put(queue.get())
+
+
+def worker_main(msfile, tasks, queue, args):
+    """
+    Smooth the antennas taken from tasks in a worker process, until a None.
+    The worker reads through its own read-only handle, without read locks so
+    that it never blocks the writer: it only reads rows of its own antenna that
+    have not been written yet (see RowBuffer), which no other process changes.
+    """
+    global ms_ro, results, smooth_args
+    ms_ro = pt.table(msfile, ack=False, lockoptions='autonoread')
+    results = queue
+    smooth_args = args
+    for task in iter(tasks.get, None):
+        smooth_worker(task)
+    ms_ro.close()
+
+
+def smooth_worker(task):
+    """
+    Smooth the rows of ant1 in a worker process and send the chunks to the writer,
+    followed by (ant1, None, error, None) once done.
+    """
+    ant1, rownrs, a_ant2, a_dist = task
+    try:
+        ms_ant1 = ms_ro.selectrows(rownrs)
+        for startrow, a_data, a_weights in smooth_antenna(ms_ant1, ant1, a_ant2, a_dist, *smooth_args):
+            results.put((ant1, startrow, a_data, a_weights))
+        ms_ant1.close()
+    except Exception:
+        results.put((ant1, None, traceback.format_exc(), None))
+        return
+    results.put((ant1, None, None, None))
+
 opt = optparse.OptionParser(usage="%prog [options] MS", version="%prog 0.1")
 opt.add_option('-f', '--ionfactor', help='Gives an indication on how strong is the ionosphere [default: 0.2]', type='float', default=0.2)
 opt.add_option('-s', '--bscalefactor', help='Gives an indication on how the smoothing varies with BL-lenght [default: 0.5]', type='float', default=0.5)
@@ -50,6 +400,11 @@ opt.add_option('-r', '--restore', help='If WEIGHT_SPECTRUM_ORIG exists then rest
 opt.add_option('-b', '--nobackup', help='Do not backup the old WEIGHT_SPECTRUM in WEIGHT_SPECTRUM_ORIG [default: do backup if -w]', action="store_true", default=False)
 opt.add_option('-a', '--onlyamp', help='Smooth only amplitudes [default: smooth real/imag]', action="store_true", default=False)
 opt.add_option('-S', '--smooth', help='Performs smoothing (otherwise column will be only copied)', type="string", default=True)
+opt.add_option('-m', '--max-memory', help='Memory budget in GB, data are read and smoothed in time chunks that fit into it [default: 0, read all rows of an antenna at once]', type='float', default=0., dest='max_memory')
+opt.add_option('-n', '--ncpu', help='Number of processes smoothing the baselines in parallel [default: 1]', type='int', default=1)
+opt.add_option('-t', '--sort-on-the-fly', help='Smooth MSs that are not time-sorted by reading the rows in time order [default: exit]', action="store_true", default=False, dest='sort_on_the_fly')
+opt.add_option('-T', '--sigma-tolerance', help='Relative width of the bins sigma is rounded to, baselines in the same bin are smoothed together, long kernels by FFT (e.g. 0.05) [default: 0, exact sigma and direct convolution]', type='float', default=0., dest='sigma_tolerance')
+opt.add_option('-l', '--lazy-copy', help='Do not copy incol to outcol before smoothing, write outcol chunk by chunk instead (unsmoothed baselines as in incol) [default: False]', action="store_true", default=False, dest='lazy_copy')
 (options, msfile) = opt.parse_args()
 
 if msfile == []:
@@ -70,14 +425,16 @@ freqtab.close()
 wav = 299792458. / freq
 timepersample = ms.getcell('INTERVAL',0)
 
-# check if ms is time-ordered
-times = ms.getcol('TIME_CENTROID')
-if not all(times[i] <= times[i+1] for i in range(len(times)-1)):
-    logging.critical('This code cannot handle MS that are not time-sorted.')
-    sys.exit(1)
+# check if ms is time-ordered, read antennas and baseline lengths on the way
+ant_rows, ant_ant2, ant_dist, time_sorted = read_metadata(ms, keep_times=options.sort_on_the_fly)
+if not time_sorted:
+    if not options.sort_on_the_fly:
+        logging.critical('This code cannot handle MS that are not time-sorted.')
+        sys.exit(1)
+    logging.warning('MS is not time-sorted, rows will be read in time order.')
 
 # create column to smooth
-addcol(ms, options.incol, options.outcol)
+addcol(ms, options.incol, options.outcol, copy=not options.lazy_copy or options.smooth == 'False')
 # if smoothing should not be performed
 if options.smooth == 'False':
     sys.exit(0)
@@ -89,80 +446,91 @@ if 'WEIGHT_SPECTRUM_ORIG' in ms.colnames() and options.restore:
 elif options.weight and not options.nobackup:
     addcol(ms, 'WEIGHT_SPECTRUM', 'WEIGHT_SPECTRUM_ORIG')
 
-# iteration on antenna1
-for ms_ant1 in ms.iter(["ANTENNA1"]):
-    ant1 = ms_ant1.getcol('ANTENNA1')[0]
-    a_ant2 = ms_ant1.getcol('ANTENNA2')
-    logging.debug('Working on antenna: %s' % ant1)
+# the rows of every antenna1 (in time order), their ANTENNA2 and the mean UVW
+# length of its baselines
+ants = sorted(ant_rows.keys())
+tasks = [(ant1, ant_rows[ant1], ant_ant2[ant1], ant_dist[ant1]) for ant1 in ants]
+meta_bytes = sum(ant_rows[ant1].nbytes + ant_ant2[ant1].nbytes for ant1 in ants)
+del ant_ant2, ant_dist
 
-    a_uvw = ms_ant1.getcol('UVW')
-    a_data = ms_ant1.getcol(options.outcol)
-    a_weights = ms_ant1.getcol('WEIGHT_SPECTRUM')
-    a_flags = ms_ant1.getcol('FLAG')
- 
-    for ant2 in set(a_ant2):
-        if ant1 == ant2: continue # skip autocorr
-        idx = np.where(a_ant2 == ant2)
-        
-        uvw = a_uvw[idx]
-        data = a_data[idx]
-        weights = a_weights[idx]
-        flags = a_flags[idx]
-   
-        # compute the FWHM
-        uvw_dist = np.sqrt(uvw[:, 0]**2 + uvw[:, 1]**2 + uvw[:, 2]**2)
-        dist = np.mean(uvw_dist) / 1.e3
-        if np.isnan(dist): continue # fix for missing anstennas
-    
-        stddev = options.ionfactor * (25.e3 / dist)**options.bscalefactor * (freq / 60.e6) # in sec
-        stddev = stddev/timepersample # in samples
-        logging.debug("%s - %s: dist = %.1f km: sigma=%.2f samples." % (ant1, ant2, dist, stddev))
-    
-        if stddev == 0: continue # fix for flagged antennas
-        if stddev < 0.5: continue # avoid very small smoothing
-    
-        flags[ np.isnan(data) ] = True # flag NaNs
-        weights[flags] = 0 # set weight of flagged data to 0
-        del flags
-        
-        # Multiply every element of the data by the weights, convolve both the scaled data and the weights, and then
-        # divide the convolved data by the convolved weights (translating flagged data into weight=0). That's basically the equivalent of a
-        # running weighted average with a Gaussian window function.
-        
-        # set bad data to 0 so nans do not propagate
-        data = np.nan_to_num(data*weights)
-        
-        # smear weighted data and weights
-        if options.onlyamp:
-            dataAMP = gfilter(np.abs(data), stddev, axis=0)
-            dataPH = np.angle(data)
-        else:
-            dataR = gfilter(np.real(data), stddev, axis=0)#, truncate=4.)
-            dataI = gfilter(np.imag(data), stddev, axis=0)#, truncate=4.)
-    
-        weights = gfilter(weights, stddev, axis=0)#, truncate=4.)
-    
-        # re-create data
-        if options.onlyamp:
-            data = dataAMP * ( np.cos(dataPH) + 1j*np.sin(dataPH) )
-        else:
-            data = (dataR + 1j * dataI)
-        data[(weights != 0)] /= weights[(weights != 0)] # avoid divbyzero
-    
-        #print np.count_nonzero(data[~flags]), np.count_nonzero(data[flags]), 100*np.count_nonzero(data[flags])/np.count_nonzero(data)
-        #print "NANs in flagged data: ", np.count_nonzero(np.isnan(data[flags]))
-        #print "NANs in unflagged data: ", np.count_nonzero(np.isnan(data[~flags]))
-        #print "NANs in weights: ", np.count_nonzero(np.isnan(weights))
-
-        a_data[idx] = data
-        if options.weight: a_weights[idx] = weights
-    
-    #logging.info('Writing %s column.' % options.outcol)
-    ms_ant1.putcol(options.outcol, a_data)
-
-    if options.weight:
-        #logging.warning('Writing WEIGHT_SPECTRUM column.')
-        ms_ant1.putcol('WEIGHT_SPECTRUM', a_weights)
+# rows per chunk fitting into the memory budget (less the metadata above): the
+# buffered input rows plus the output block and the temporaries take about
+# three times the raw row size
+max_rows = 0
+if options.max_memory > 0:
+    nchan, ncorr = ms.getcell(options.incol, 0).shape
+    rowbytes = nchan * ncorr * (np.dtype(np.complex64).itemsize + np.dtype(np.float32).itemsize + np.dtype(np.bool_).itemsize)
+    # with several processes the budget is shared by the workers and the chunks waiting to be written
+    nshare = options.ncpu + 1 if options.ncpu > 1 else 1
+    budget = options.max_memory * 1024**3 - meta_bytes
+    if budget <= 0:
+        logging.warning('The metadata of the MS (%.2f GB) exceed the memory budget.' % (meta_bytes / 1024.**3))
+    max_rows = max(int(budget / (3. * rowbytes * nshare)), 1)
+
+smooth_args = (freq, timepersample, options, max_rows)
+if options.ncpu <= 1:
+    # iteration on antenna1
+    for ant1, rownrs, a_ant2, a_dist in tasks:
+        ms_ant1 = ms.selectrows(rownrs)
+        for startrow, a_data, a_weights in smooth_antenna(ms_ant1, ant1, a_ant2, a_dist, *smooth_args):
+            write_chunk(ms_ant1, startrow, a_data, a_weights, options.outcol, options.weight)
+        ms_ant1.close()
+else:
+    # the workers read through their own read-only handle, this process is the
+    # only writer; the bounded queue keeps at most ncpu chunks waiting for it.
+    # The writer holds the lock only while writing (an automatic lock would be
+    # kept while waiting on the queue, and block the workers). The MS is
+    # reopened only after the fork, the workers must not inherit the open table
+    # (and its file descriptors). Plain processes rather than a Pool: a Pool
+    # replaces a killed worker by a fork of this process, which may hang.
+    logging.info('Smoothing with %i processes.' % options.ncpu)
+    ms.close()
+    tasks_queue = multiprocessing.Queue()
+    queue = multiprocessing.Queue(options.ncpu)
+    workers = [multiprocessing.Process(target=worker_main, args=(msfile, tasks_queue, queue, smooth_args))
+               for i in range(options.ncpu)]
+    for p in workers:
+        p.daemon = True
+        p.start()
+    ms = pt.table(msfile, readonly=False, ack=False, lockoptions='user')
+    for task in tasks + [None] * options.ncpu:
+        tasks_queue.put(task)
+    received = thread_queue.Queue(1)
+    reader = threading.Thread(target=forward_results, args=(queue, received))
+    reader.daemon = True
+    reader.start()
+    selections = {}
+    ndone = 0
+    while ndone < len(ants):
+        try:
+            ant1, startrow, a_data, a_weights = received.get(timeout=10)
+        except thread_queue.Empty:
+            # a worker that was killed (e.g. out of memory) never reports back
+            dead = [p.exitcode for p in workers if p.exitcode not in (None, 0)]
+            if len(dead) > 0:
+                logging.critical('A smoothing process died (exit codes: %s).' % dead)
+                tasks_queue.cancel_join_thread()
+                for p in workers:
+                    p.terminate()
+                sys.exit(1)
+            continue
+        if ant1 not in selections:
+            selections[ant1] = ms.selectrows(ant_rows[ant1])
+        if startrow is None:
+            if a_data is not None:
+                logging.critical('Smoothing of antenna %s failed:\n%s' % (ant1, a_data))
+                tasks_queue.cancel_join_thread()
+                for p in workers:
+                    p.terminate()
+                sys.exit(1)
+            selections.pop(ant1).close()
+            ndone += 1
+            continue
+        ms.lock(write=True)
+        write_chunk(selections[ant1], startrow, a_data, a_weights, options.outcol, options.weight)
+        ms.unlock()
+    for p in workers:
+        p.join()
 
 ms.close()
 logging.info("Done.")
@@ -7,6 +7,8 @@ import sys, os
 import numpy as np
 from lofarpipe.support.data_map import DataMap
 from lofarpipe.support.data_map import DataProduct
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from ms_metadata import get_ms_metadata
 import argparse
 from argparse import RawTextHelpFormatter
 
@@ -19,17 +21,14 @@ class Band(object):
         self.msnames = [ MS.split('/')[-1] for MS in self.files ]
         self.numMS = len(self.files)
         # Get the frequency info and set name
-        sw = pt.table(self.files[0]+'::SPECTRAL_WINDOW', ack=False)
-        self.freq = sw.col('REF_FREQUENCY')[0]
-        self.nchan = sw.col('NUM_CHAN')[0]
-        self.chan_freqs_hz = sw.col('CHAN_FREQ')[0]
-        self.chan_width_hz = sw.col('CHAN_WIDTH')[0][0]
-        sw.close()
+        metadata = get_ms_metadata(self.files[0])
+        self.freq = metadata['ref_freq']
+        self.nchan = metadata['nchan']
+        self.chan_freqs_hz = metadata['chan_freq']
+        self.chan_width_hz = metadata['chan_width'][0]
         self.name = str(int(self.freq/1e6))
         # Get the station diameter
-        ant = pt.table(self.files[0]+'::ANTENNA', ack=False)
-        self.diam = float(ant.col('DISH_DIAMETER')[0])
-        ant.close()
+        self.diam = float(metadata['dish_diameter'][0])
 
     def get_image_sizes(self, cellsize_highres_deg=None, cellsize_lowres_deg=None,
                         fieldsize_highres=2.5, fieldsize_lowres=6.5):
@@ -248,9 +247,7 @@ def main(ms_input, outmapname=None, mapfile_dir=None, cellsize_highres_deg=0.002
     msdict = {}
     for ms in ms_list:
         # group all MSs by frequency
-        sw = pt.table(ms+'::SPECTRAL_WINDOW', ack=False)
-        msfreq = int(sw.col('REF_FREQUENCY')[0])
-        sw.close()
+        msfreq = int(get_ms_metadata(ms)['ref_freq'])
         if msfreq in msdict:
             msdict[msfreq].append(ms)
         else:
@@ -10,11 +10,12 @@ import matplotlib
 matplotlib.use('Agg') # Force matplotlib to not use any Xwindows backend.
 import pylab
 import pyrap.quanta as qa
-import pyrap.tables as pt
 import pyrap.measures as pm
 import sys
 import numpy
 import os
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from ms_metadata import get_ms_metadata, get_unique_times
 
 targets = [ {'name' : 'CasA', 'ra' : 6.123487680622104,  'dec' : 1.0265153995604648},
             {'name' : 'CygA', 'ra' : 5.233686575770755,  'dec' : 0.7109409582180791},
@@ -44,7 +45,57 @@ def input2strlist_nomapfile(invar):
    return str_list
 
 ########################################################################
-def main(ms_input, min_separation = 30, outputimage = None):
+def sidereal_time(time, longitude):
+   """
+   Local mean sidereal time of UTC time stamps in MJD seconds (as in the TIME
+   column of an MS), for arrays of time stamps
+
+   Uses the Earth rotation angle and the IAU 2006 polynomial of the GMST,
+   assuming UT1 = UTC (which is accurate to better than a second)
+
+   Parameters
+   ----------
+   time : array
+       Time stamps in MJD seconds
+   longitude : float
+       Longitude of the observer in rad
+
+   Returns
+   -------
+   lst : array
+       Local sidereal time in rad
+   """
+   days = numpy.asarray(time) / 86400.0 - 51544.5
+   era = 2.0 * numpy.pi * (0.7790572732640 + 1.00273781191135448 * days)
+   centuries = days / 36525.0
+   precession = (0.014506 + 4612.156534 * centuries + 1.3915817 * centuries**2) / 3600.0 / 180.0 * numpy.pi
+   return numpy.mod(era + precession + longitude, 2.0 * numpy.pi)
+
+########################################################################
+def elevation(ra, dec, lst, latitude):
+   """
+   Elevation of apparent positions for arrays of sidereal times (the same as
+   the AZEL frame of casacore measures, i.e., for the geocentric latitude)
+
+   Parameters
+   ----------
+   ra, dec : float or array
+       Apparent right ascension and declination in rad
+   lst : array
+       Local sidereal time in rad
+   latitude : float
+       Geocentric latitude of the observer in rad
+
+   Returns
+   -------
+   el : array
+       Elevation in rad
+   """
+   return numpy.arcsin(numpy.sin(latitude) * numpy.sin(dec) +
+                       numpy.cos(latitude) * numpy.cos(dec) * numpy.cos(lst - ra))
+
+########################################################################
+def main(ms_input, min_separation = 30, outputimage = None, time_step = 60):
 
     """
     Print seperation of the phase reference center of an input MS 
@@ -54,6 +105,13 @@ def main(ms_input, min_separation = 30, outputimage = None):
     ----------
     ms_input : str
         String from the list (map) of the calibrator MSs
+    min_separation : int, optional
+        Minimal accepted distance to an A-team source in degrees
+    outputimage : str, optional
+        Filename of the elevation plot
+    time_step : float, optional
+        Sampling of the elevations in seconds, they are interpolated to the
+        time stamps of the MS in between
         
     Returns
     -------
@@ -66,35 +124,36 @@ def main(ms_input, min_separation = 30, outputimage = None):
     # Create a measures object
     me = pm.measures()
 
-    # Open the measurement set and the antenna and pointing table
-    ms = pt.table(msname)  
-
     # Get the position of the first antenna and set it as reference frame
-    ant_table = pt.table(msname + '/ANTENNA')  
+    metadata = get_ms_metadata(msname)
     ant_no = 0
-    pos = ant_table.getcol('POSITION')
+    pos = metadata['antenna_positions']
     x = qa.quantity( pos[ant_no,0], 'm' )
     y = qa.quantity( pos[ant_no,1], 'm' )
     z = qa.quantity( pos[ant_no,2], 'm' )
     position =  me.position( 'wgs84', x, y, z )
     me.doframe( position )
-    ant_table.close()
 
     # Get the first pointing of the first antenna
-    field_table = pt.table(msname + '/FIELD')
-    field_no = 0
-    direction = field_table.getcol('PHASE_DIR')
-    ra = direction[ ant_no, field_no, 0 ]
-    dec = direction[ ant_no, field_no, 1 ]
+    ra = metadata['phase_dir'][0]
+    dec = metadata['phase_dir'][1]
     targets.insert(0, {'name' : 'Pointing', 'ra' : ra, 'dec' : dec})
-    field_table.close()
 
     # Get a ordered list of unique time stamps from the measurement set
-    time_table = pt.taql('select TIME from $1 orderby distinct TIME', tables = [ms])
-    time = time_table.getcol('TIME')
+    time = get_unique_times(msname)
     time1 = time/3600.0
     time1 = time1 - pylab.floor(time1[0]/24)*24
 
+    # Sample the elevations on a coarse time grid, using the (geocentric)
+    # longitude and latitude of the reference position and the sidereal time
+    time_step = float(time_step)
+    nsteps = max(int(numpy.ceil((time[-1] - time[0]) / time_step)), 1)
+    time_grid = numpy.linspace(time[0], time[-1], nsteps + 1)
+    geo = me.measure(position, 'itrf')
+    longitude = geo['m0']['value']
+    latitude = geo['m1']['value']
+    lst = sidereal_time(time_grid, longitude)
+
     ra_qa  = qa.quantity( targets[0]['ra'], 'rad' )
     dec_qa = qa.quantity( targets[0]['dec'], 'rad' )
     pointing =  me.direction('j2000', ra_qa, dec_qa)
@@ -121,18 +180,27 @@ def main(ms_input, min_separation = 30, outputimage = None):
       
         separations.append(me.separation(pointing, direction))
 
-        # Loop through all time stamps and calculate the elevation of the pointing
-        el = []
-        for t in time:
+        # Get the topocentric apparent position on the time grid (only the
+        # solar system objects move) and calculate the elevations for all of it
+        # at once
+        if 'ra' in target.keys():
+            sample_times = time_grid[:1]
+        else:
+            sample_times = time_grid
+            pass
+        ra_app = []
+        dec_app = []
+        for t in sample_times:
             t_qa = qa.quantity(t, 's')
             t1 = me.epoch('utc', t_qa)
             me.doframe(t1)
-            a = me.measure(direction, 'azel')
-            elevation = a['m1']
-            el.append(elevation['value']/pylab.pi*180)
+            a = me.measure(direction, 'topo')
+            ra_app.append(a['m0']['value'])
+            dec_app.append(a['m1']['value'])
             pass
-        
-        el = numpy.array(el)
+
+        el = elevation(numpy.array(ra_app), numpy.array(dec_app), lst, latitude)
+        el = numpy.interp(time, time_grid, el)/pylab.pi*180
         pylab.plot(time1, el)
         
         if target['name'] != 'Pointing':
@@ -174,9 +242,10 @@ if __name__ == '__main__':
     parser.add_argument('MSfile', type=str, nargs='+', help='One (or more MSs).')
     parser.add_argument('--min_separation', type=int, default=30, help='minimal accepted distance to an A-team source on the sky in degrees (will raise a WARNING). Default: 30')
     parser.add_argument('--outputimage', type=str, default=None, help='location of the elevation plot of the A-Team sources.')
+    parser.add_argument('--time_step', type=float, default=60, help='sampling of the elevations in seconds, they are interpolated in between. Default: 60')
         
     args = parser.parse_args()
     
-    main(args.MSfile, args.min_separation, args.outputimage)
+    main(args.MSfile, args.min_separation, args.outputimage, args.time_step)
     
     pass
@@ -4,7 +4,104 @@ Flag MS if unflagged fraction is too low.
 """
 import argparse
 import os
+import sys
 import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from ms_metadata import get_ms_metadata
+
+
+def find_flag_statistics(ms_file, max_bytes=256*1024**2):
+    """
+    Finds the unflagged fraction of the data, also per antenna, channel,
+    time slot and correlation
+
+    The FLAG column is read in blocks of rows, so the memory use does not
+    depend on the size of the MS.
+
+    Parameters
+    ----------
+    ms_file : str
+        Filename of input MS
+    max_bytes : int, optional
+        Memory budget of a block of flags in bytes (the flags and their
+        negation); the number of rows per block follows from the number of
+        channels and correlations
+
+    Returns
+    -------
+    statistics : dict
+        Dict with the unflagged fraction of all data ('unflagged_fraction')
+        and arrays with the unflagged fraction per antenna ('antenna', in the
+        order of 'antenna_names'), per channel ('channel'), per time slot
+        ('time', for the time stamps in 'times') and per correlation
+        ('correlation'). Antennas and time slots without data have a
+        fraction of NaN.
+    """
+    import casacore.tables as pt
+
+    antenna_names = get_ms_metadata(ms_file)['antenna_names']
+    nant = len(antenna_names)
+    ant_unflagged = np.zeros(nant)
+    ant_total = np.zeros(nant)
+    chan_unflagged = None
+    times = np.zeros(0)
+    time_unflagged = np.zeros(0)
+    time_total = np.zeros(0)
+
+    t = pt.table(ms_file, ack=False)
+    nrow = 1
+    if t.nrows() > 0:
+        nchan, ncorr = t.getcell('FLAG', 0).shape
+        nrow = max(1, int(max_bytes // (2 * nchan * ncorr * np.dtype(bool).itemsize)))
+    for startrow in range(0, t.nrows(), nrow):
+        nrow_block = min(nrow, t.nrows() - startrow)
+        unflagged = ~t.getcol('FLAG', startrow, nrow_block)
+        ant1 = t.getcol('ANTENNA1', startrow, nrow_block)
+        ant2 = t.getcol('ANTENNA2', startrow, nrow_block)
+        time = t.getcol('TIME', startrow, nrow_block)
+        if chan_unflagged is None:
+            chan_unflagged = np.zeros(unflagged.shape[1])
+            corr_unflagged = np.zeros(unflagged.shape[2])
+
+        row_unflagged = np.sum(unflagged, axis=(1, 2))
+        row_total = np.zeros(nrow_block) + unflagged.shape[1] * unflagged.shape[2]
+        chan_unflagged += np.sum(unflagged, axis=(0, 2))
+        corr_unflagged += np.sum(unflagged, axis=(0, 1))
+
+        # a baseline counts for both of its antennas (autocorrelations only once)
+        cross = ant1 != ant2
+        ant_unflagged += np.bincount(ant1, row_unflagged, nant)
+        ant_unflagged += np.bincount(ant2[cross], row_unflagged[cross], nant)
+        ant_total += np.bincount(ant1, row_total, nant)
+        ant_total += np.bincount(ant2[cross], row_total[cross], nant)
+
+        # the time slots of a block are merged into those of the previous blocks
+        block_times, time_idx = np.unique(time, return_inverse=True)
+        new_times = np.union1d(times, block_times)
+        old_idx = np.searchsorted(new_times, times)
+        block_idx = np.searchsorted(new_times, block_times)
+        if len(new_times) > len(times):
+            counts = np.zeros((2, len(new_times)))
+            counts[:, old_idx] = [time_unflagged, time_total]
+            time_unflagged, time_total = counts
+            times = new_times
+        time_unflagged += np.bincount(block_idx[time_idx], row_unflagged, len(times))
+        time_total += np.bincount(block_idx[time_idx], row_total, len(times))
+    t.close()
+
+    if chan_unflagged is None:
+        raise ValueError('find_flag_statistics: {0} contains no data!'.format(ms_file))
+    total = np.sum(time_total)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        statistics = {'unflagged_fraction': float(np.sum(time_unflagged) / total),
+                      'antenna_names': antenna_names,
+                      'antenna': ant_unflagged / ant_total,
+                      'channel': chan_unflagged / (total / len(chan_unflagged)),
+                      'times': times,
+                      'time': time_unflagged / time_total,
+                      'correlation': corr_unflagged / (total / len(corr_unflagged))}
+    return statistics
+
 
 def find_unflagged_fraction(ms_file):
     """
@@ -18,17 +115,20 @@ def find_unflagged_fraction(ms_file):
     unflagged_fraction : float
         Fraction of unflagged data
     """
-    import subprocess
+    return find_flag_statistics(ms_file)['unflagged_fraction']
+
 
-    # Call taql. Note that we do not use pt.taql(), as pt.taql() can cause
-    # hanging/locking issues on some systems
-    p = subprocess.Popen("taql 'CALC sum([select nfalse(FLAG) from {0}]) / "
-        "sum([select nelements(FLAG) from {0}])'".format(ms_file),
-        shell=True, stdout=subprocess.PIPE)
-    r = p.communicate()
-    unflagged_fraction = float(r[0])
+def find_flagged_antennas(statistics):
+    """
+    Returns the names of the antennas whose data are fully flagged
 
-    return unflagged_fraction
+    Parameters
+    ----------
+    statistics : dict
+        Flag statistics as returned by find_flag_statistics()
+    """
+    return [name for name, fraction in zip(statistics['antenna_names'], statistics['antenna'])
+            if fraction == 0.]
 
 def main(ms_file, min_fraction=0.01, print_fraction=False):
     """
@@ -50,9 +150,13 @@ def main(ms_file, min_fraction=0.01, print_fraction=False):
 
     """
     min_fraction = float(min_fraction)
-    unflagged_fraction = find_unflagged_fraction(ms_file)
+    statistics = find_flag_statistics(ms_file)
+    unflagged_fraction = statistics['unflagged_fraction']
     if print_fraction:
         print("File %s has %.2f%% unflagged data."%(os.path.basename(ms_file),unflagged_fraction*100.))
+        flagged_antennas = find_flagged_antennas(statistics)
+        if flagged_antennas:
+            print("Fully flagged antennas: %s"%(', '.join(flagged_antennas)))
     if unflagged_fraction < min_fraction:
         print('check_unflagged_fraction.py: Unflagged fraction of {0} is: {1}, '
               'removing file.'.format(os.path.basename(ms_file), str(unflagged_fraction)))
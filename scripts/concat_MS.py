@@ -5,9 +5,11 @@ import re
 import pyrap.tables as pt
 import numpy
 import os
+import multiprocessing
 from lofarpipe.support.data_map import DataMap, DataProduct
 
-global_limit = 637871244
+global_limit = 637871244  # in kB
+data_columns = ['DATA', 'FLAG', 'WEIGHT_SPECTRUM']
 ########################################################################
 def input2strlist_nomapfile(invar):
    """
@@ -28,21 +30,100 @@ def input2strlist_nomapfile(invar):
 
 ########################################################################
 def getsystemmemory():
-   
-   memory = int(os.popen('cat /proc/meminfo | grep MemAvailable').readlines()[0].split(':')[-1].split()[0])
-   return memory
-   pass
+   """
+   Return the available system memory in kB (as given in /proc/meminfo)
+   """
+   with open('/proc/meminfo') as f:
+       for line in f:
+           if line.startswith('MemAvailable:'):
+               return int(line.split(':')[-1].split()[0])
+   raise ValueError('concat_MS: MemAvailable not found in /proc/meminfo!')
 
 ########################################################################
-def getfilesize(MS):
-   
-   size = int(os.popen('du -cks ' + MS).readlines()[0].split()[0])
+def getdatasize(MS):
+   """
+   Return the number of bytes in the data columns of an MS
+
+   This is the size of the DATA, FLAG and WEIGHT_SPECTRUM columns (rows x
+   channels x correlations x size of the data type), i.e. the data that
+   AOFlagger has to hold for this MS.
+   """
+   t = pt.table(MS, ack=False)
+   size = 0
+   if t.nrows() > 0:
+       for column in data_columns:
+           if column in t.colnames():
+               cell = t.getcell(column, 0)
+               size += t.nrows() * cell.size * cell.itemsize
+   t.close()
    return size
 
-   pass
+########################################################################
+def plan_groups(sizes, limit):
+   """
+   Split a list of files into consecutive groups of balanced size
+
+   Parameters
+   ----------
+   sizes : list of float
+       Size of each file
+   limit : float
+       Maximum size of a group (a single file that is larger than this gets
+       its own group)
+
+   Returns
+   -------
+   borders : list of int
+       Index of the first file of every group and the number of files, i.e.
+       group i consists of the files borders[i]:borders[i+1]
+   """
+   sizes    = numpy.array(sizes, dtype=float)
+   cumsize  = numpy.cumsum(sizes)
+   ngroups  = max(1, int(numpy.ceil(cumsize[-1] / limit)))
+   while True:
+       # put each border next to the file where the cumulative size is closest
+       # to the ideal (equal) share of the total size
+       targets = numpy.arange(1, ngroups) * cumsize[-1] / ngroups
+       borders = numpy.searchsorted(cumsize, targets)
+       closer  = numpy.abs(cumsize[borders] - targets) < numpy.abs(cumsize[borders] - sizes[borders] - targets)
+       borders = numpy.unique(numpy.concatenate(([0], borders + closer, [len(sizes)])))
+       groupsizes = numpy.diff(numpy.concatenate(([0.], cumsize))[borders])
+       if numpy.all((groupsizes <= limit) | (numpy.diff(borders) == 1)) or ngroups >= len(sizes):
+           return [int(b) for b in borders]
+       ngroups += 1
+
+########################################################################
+def concat_exists(files, MS):
+   """
+   Check whether MS is a virtual concatenation of exactly the given files
+
+   pt.msconcat() writes MS as a table that refers to the concatenation in
+   MS_CONCAT, so the names of the parts are those of MS_CONCAT.
+   """
+   if not os.path.isdir(MS) or not os.path.isdir(MS + '_CONCAT'):
+       return False
+   try:
+       t     = pt.table(MS, ack=False)
+       t.close()
+       t     = pt.table(MS + '_CONCAT', ack=False)
+       parts = t.partnames()
+       t.close()
+   except RuntimeError:
+       # e.g. left over from an interrupted run
+       return False
+   return [os.path.realpath(part) for part in parts] == [os.path.realpath(f) for f in files]
 
 ########################################################################
-def main(ms_input, ms_output, min_length, overhead = 0.8, filename=None, mapfile_dir=None):
+def concat_group(task):
+   """
+   Virtually concatenate one group of files, task is (files, output name)
+   """
+   files, MS = task
+   pt.msconcat(files, MS)
+   return MS
+
+########################################################################
+def main(ms_input, ms_output, min_length, overhead = 0.8, filename=None, mapfile_dir=None, aoflagger_factor = 1.5, ncpu = 4, incremental = True):
 
     """
     Virtually concatenate subbands
@@ -61,58 +142,96 @@ def main(ms_input, ms_output, min_length, overhead = 0.8, filename=None, mapfile
         Name of output mapfile
     mapfile_dir : str
         Directory for output mapfile
+    aoflagger_factor : float
+        Memory needed by AOFlagger with -memory-read in units of the size of the data
+        (DATA, FLAG and WEIGHT_SPECTRUM) of a group. Next to the data of all subbands of
+        the group it keeps working copies of the baseline that is being flagged.
+    ncpu : int
+        Number of groups to concatenate in parallel
+    incremental : bool
+        Skip groups for which the concatenated MS already exists and references the
+        same files (e.g. when resuming a pipeline run)
+
+    Returns
+    -------
+    result : dict
+        Dict with the name of the mapfile of the concatenated MSs, the memory option
+        for AOFlagger that suits all groups and the name of a mapfile with the memory
+        option of each group
 
     """
-    system_memory = getsystemmemory()
-    filelist      = input2strlist_nomapfile(ms_input)
-    file_size     = getfilesize(filelist[0])
-    overhead      = float(overhead)
+    system_memory    = getsystemmemory()
+    filelist         = input2strlist_nomapfile(ms_input)
+    overhead         = float(overhead)
+    min_length       = int(min_length)
+    aoflagger_factor = float(aoflagger_factor)
+    ncpu             = int(ncpu)
+    if type(incremental) is str:
+        incremental = incremental.upper() in ['TRUE', 'T', '1']
 
     print "Detected available system memory is: " + str(int(((system_memory / 1024. / 1024.) + 0.5))) + " GB" 
-    #print "Detected file size is: " + str(int(((file_size / 1024. / 1024.) + 0.5))) + " GB" 
     if overhead * system_memory > global_limit:
         system_memory = global_limit
         overhead      = 1.0
         print "Number of files to concat will be limited to the global limit of: " + str(int(((global_limit / 1024. / 1024.) + 0.5))) + " GB" 
         pass    
-    
-    #i = 1
-    max_space     = overhead * system_memory / file_size
-    max_length    = len(filelist) / int((len(filelist) / max_space) + 1.)
-
-    #while max_length * file_size > overhead * system_memory:
-        #i += 1
-        #max_length = len(filelist) / ((len(filelist) / max_space) + i)
-        #pass
-    
-    if max_length >= int(min_length):
-        memory = '-memory-read'
-        pass
-    else:
-        memory = '-indirect-read'
-        max_length = len(filelist)
-        if max_length * file_size > global_limit:
-            max_space  = global_limit / file_size
-            max_length = len(filelist) / int((len(filelist) / max_space) + 1.)
+    memory_limit = overhead * system_memory * 1024.
+
+    data_sizes    = numpy.array([getdatasize(ms) for ms in filelist], dtype=float)
+    working_sizes = aoflagger_factor * data_sizes
+    print "Total size of the data is: " + str(int(((numpy.sum(data_sizes) / 1024.**3) + 0.5))) + " GB"
+
+    # largest groups that AOFlagger can flag in memory
+    set_ranges = plan_groups(working_sizes, memory_limit)
+    if min(numpy.diff(set_ranges)) < min_length:
+        # not enough memory for groups of min_length subbands: use groups that are only
+        # limited by the global limit, and flag those that don't fit with indirect-read
+        set_ranges = plan_groups(data_sizes, global_limit * 1024.)
+        if len(set_ranges) > 2 and min(numpy.diff(set_ranges)) < min_length:
             print "Number of files to concat was limited to the global limit of: " + str(int(((global_limit / 1024. / 1024.) + 0.5))) + " GB" 
             print "WARNING: The number of concatenated files will thus be lower than the min_length of: "  + str(min_length)
             pass
         pass
-    
-    print "Applying an overhead of: " + str(overhead)
-    print "The max_length value is: " + str(max_length)
-    set_ranges     = list(numpy.arange(0, len(filelist) + 1, int(max_length)))
-    set_ranges[-1] = len(filelist)
 
-    map_out = DataMap([])
+    print "Applying an overhead of: " + str(overhead)
+    map_out    = DataMap([])
+    memory_map = DataMap([])
+    memories   = []
+    tasks      = []
     for i in numpy.arange(len(set_ranges) - 1):
         f = ms_output + '_' + str(i)
-        pt.msconcat(filelist[set_ranges[i]:set_ranges[i + 1]], f)
+        if numpy.sum(working_sizes[set_ranges[i]:set_ranges[i + 1]]) <= memory_limit:
+            memory = '-memory-read'
+        else:
+            memory = '-indirect-read'
+        print "Group " + str(i) + " has " + str(set_ranges[i + 1] - set_ranges[i]) + " files and will use " + memory
+        if incremental and concat_exists(filelist[set_ranges[i]:set_ranges[i + 1]], f):
+            print "Concatenated MS " + f + " already exists, skipping it"
+        else:
+            tasks.append((filelist[set_ranges[i]:set_ranges[i + 1]], f))
         map_out.data.append(DataProduct('localhost', f, False))
+        memory_map.data.append(DataProduct('localhost', memory, False))
+        memories.append(memory)
+
+    # the groups are independent, so they can be concatenated in parallel
+    if ncpu > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(ncpu, len(tasks)))
+        pool.map(concat_group, tasks)
+        pool.close()
+        pool.join()
+    else:
+        for task in tasks:
+            concat_group(task)
 
     fileid = os.path.join(mapfile_dir, filename)
     map_out.save(fileid)
-    result = {'concatmapfile': fileid, 'memory': memory}
+    memoryid = os.path.join(mapfile_dir, filename + '_memory')
+    memory_map.save(memoryid)
+    if all(memory == '-memory-read' for memory in memories):
+        memory = '-memory-read'
+    else:
+        memory = '-indirect-read'
+    result = {'concatmapfile': fileid, 'memory': memory, 'memorymapfile': memoryid}
 
     return result
 
@@ -129,9 +248,16 @@ if __name__ == '__main__':
                         help='Minimum amount of subbands to concatenate in frequency.')
     parser.add_argument('--overhead', type=float, default=0.8,
                         help='Only use this fraction of the available memory for deriving the amount of data to be concatenated.')
+    parser.add_argument('--aoflagger_factor', type=float, default=1.5,
+                        help='Memory needed by AOFlagger with -memory-read in units of the size of the data.')
+    parser.add_argument('--ncpu', type=int, default=4,
+                        help='Number of groups to concatenate in parallel.')
+    parser.add_argument('--no_incremental', action='store_false', dest='incremental',
+                        help='Concatenate all groups again, even if the concatenated MS already exists.')
 
 
 
     args = parser.parse_args()
 
-    main(args.MSfile,args.MSout,args.min_length,args.overhead)
+    main(args.MSfile,args.MSout,args.min_length,args.overhead,aoflagger_factor=args.aoflagger_factor,
+         ncpu=args.ncpu,incremental=args.incremental)
@@ -1,10 +1,11 @@
 #!/usr/bin/env python
 import os,sys
 import glob
-import pyrap.tables as pt
 import numpy as np
 import time
 import lsmtool
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from ms_metadata import get_ms_metadata
 
 ########################################################################
 def grab_coord_MS(MS):
@@ -24,7 +25,7 @@ def grab_coord_MS(MS):
 
     # reading the coordinates ("position") from the MS
     # NB: they are given in rad,rad (J2000)
-    [[[ra,dec]]] = pt.table(MS+'::FIELD', readonly=True, ack=False).getcol('PHASE_DIR')
+    [ra,dec] = get_ms_metadata(MS)['phase_dir']
 
     # RA is stocked in the MS in [-pi;pi]
     # => shift for the negative angles before the conversion to deg (so that RA in [0;2pi])
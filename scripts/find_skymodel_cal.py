@@ -1,10 +1,12 @@
 #!/usr/bin/env python
 import os
+import sys
 import glob
-import pyrap.tables as pt
 import math
 import lsmtool
 import numpy
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from ms_metadata import get_ms_metadata
     
 def grab_pointing(MS):
     """
@@ -23,7 +25,7 @@ def grab_pointing(MS):
         NB: we suppose that all the calibrators' observations have this field filled in (MS/Observation, column LOFAR_TARGET)
     """
     
-    [ra, dec] = pt.table(MS+'/FIELD', readonly=True, ack=False).getcol('PHASE_DIR')[0][0] * 180 / math.pi
+    [ra, dec] = get_ms_metadata(MS)['phase_dir'] * 180 / math.pi
     return ra, dec
 
     
@@ -12,6 +12,8 @@ import casacore.tables as pt
 import sys
 import os
 import glob
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from ms_metadata import get_ms_metadata
 
 
 def ra2hhmmss(deg):
@@ -50,6 +52,319 @@ def convert_radec_str(ra, dec):
     return sra, sdec
 
 
+def read_components(fits_models, fits_masks, chunksize=4194304):
+    """
+    Extract the clean components from memory-mapped model and mask images
+
+    The model images are scanned in chunks of pixels for nonzero values, and
+    only the masks at the pixels found are read, so that the memory use is set
+    by the number of components instead of the image size.
+
+    Parameters
+    ----------
+    fits_models : list
+        Filenames of the FITS model images
+    fits_masks : list
+        Filenames of the FITS mask images (same order as fits_models)
+    chunksize : int, optional
+        Number of pixels of a model image to scan at once
+
+    Returns
+    -------
+    pixels : array
+        Flat indices of the pixels that are nonzero in any model image (ncomp)
+    fluxes : array
+        Fluxes of these pixels in the model images (nfreq, ncomp)
+    masks : array
+        Values of the masks at these pixels (nfreq, ncomp)
+    shape : tuple
+        Shape of the images
+
+    """
+    indices = []
+    values = []
+    shape = None
+    for f in fits_models:
+        hdulist = fits.open(f, memmap=True)
+        data = hdulist[0].data
+        shape = data.shape
+        flat = data.reshape(-1)
+        ind = []
+        val = []
+        for start in range(0, flat.size, chunksize):
+            chunk = flat[start:start+chunksize]
+            nonzero = np.flatnonzero(chunk)
+            ind.append(nonzero + start)
+            val.append(np.array(chunk[nonzero]))
+        indices.append(np.concatenate(ind))
+        values.append(np.concatenate(val))
+        del data, flat, chunk
+        hdulist.close()
+
+    pixels = np.unique(np.concatenate(indices))
+    fluxes = np.zeros((len(fits_models), len(pixels)), dtype=values[0].dtype)
+    for i, (ind, val) in enumerate(zip(indices, values)):
+        fluxes[i, np.searchsorted(pixels, ind)] = val
+
+    masks = []
+    for f in fits_masks:
+        hdulist = fits.open(f, memmap=True)
+        masks.append(np.array(hdulist[0].data.reshape(-1)[pixels]))
+        hdulist.close()
+    masks = np.array(masks)
+
+    return pixels, fluxes, masks, shape
+
+
+def interpolate_fluxes(freqs, fluxes, valid, freq, interp='linear'):
+    """
+    Interpolate the fluxes of clean components to one or more frequencies
+
+    For each component only the frequencies at which it lies inside the mask
+    are used. The components are grouped by this set of frequencies, so that
+    all components of a group are interpolated at once (and to all target
+    frequencies at once).
+
+    Parameters
+    ----------
+    freqs : array
+        Sorted frequencies of the model images in Hz (nfreq)
+    fluxes : array
+        Fluxes of the components in the model images (nfreq, ncomp)
+    valid : array of bool
+        True where a component lies inside the mask (nfreq, ncomp)
+    freq : float or array
+        Frequency or frequencies in Hz to interpolate to (nout)
+    interp : str, optional
+        Interpolation method (see main())
+
+    Returns
+    -------
+    flux : array
+        Flux of the components at freq (ncomp, or (nout, ncomp) if freq is an
+        array)
+    ok : array of bool
+        True for the components for which freq is within +/- 4 MHz of their
+        sampled frequency range (same shape as flux)
+
+    """
+    out_freqs = np.atleast_1d(np.asarray(freq, dtype=float))
+    ncomp = fluxes.shape[1]
+    flux = np.zeros((len(out_freqs), ncomp))
+    ok = np.zeros((len(out_freqs), ncomp), dtype=bool)
+
+    if ncomp > 0:
+        patterns, group = np.unique(valid.T, axis=0, return_inverse=True)
+        group = group.ravel()
+    else:
+        patterns = []
+    for g, pattern in enumerate(patterns):
+        if not np.any(pattern):
+            continue
+        members = np.where(group == g)[0]
+        freq_array = freqs[pattern]
+        flux_array = fluxes[pattern][:, members]
+
+        # Only create a source entry if the frequency is within +/- 4 MHz of
+        # the sampled frequency range to prevent large extrapolations when
+        # the primary beam may cause rapid spectral changes
+        inside = (out_freqs > freq_array[0]-4e6) & (out_freqs < freq_array[-1]+4e6)
+        ok[np.ix_(inside, members)] = True
+
+        # If the frequency lies outside range, just use nearest freq
+        below = inside & ((out_freqs < freq_array[0]) | (len(freq_array) == 1))
+        above = inside & (out_freqs > freq_array[-1]) & ~below
+        between = inside & ~below & ~above
+        flux[np.ix_(below, members)] = flux_array[0]
+        flux[np.ix_(above, members)] = flux_array[-1]
+        if np.any(between):
+            # Otherwise interpolate
+            flux[np.ix_(between, members)] = scipy.interpolate.interp1d(freq_array, flux_array,
+                kind=interp, axis=0)(out_freqs[between])
+
+    if np.ndim(freq) == 0:
+        return flux[0], ok[0]
+    return flux, ok
+
+
+def get_band(ms_file):
+    """
+    Return the frequency and frequency range of an MS
+
+    Parameters
+    ----------
+    ms_file : str
+        Filename of the MS. Can be a list of files (e.g., '[ms1,ms2,...]'), in
+        which case they should all have the same frequency
+
+    Returns
+    -------
+    band : tuple
+        Reference frequency, lowest and highest channel frequency in Hz
+    """
+    if '[' in ms_file and ']' in ms_file:
+        files = ms_file.strip('[] ').split(',')
+        ms_file = files[0]
+    sw = get_ms_metadata(ms_file.strip('\'\" '))
+    return (sw['ref_freq'], sw['chan_freq'][0], sw['chan_freq'][-1])
+
+
+def write_skymodels(skymodels, ms_freqs, w, freqs, pixels, fluxes, masks, shape,
+                    min_flux_jy=0.005, interp='linear'):
+    """
+    Write makesourcedb sky models at one or more frequencies from a component
+    table (see read_components())
+
+    Parameters
+    ----------
+    skymodels : list
+        Filenames of the output makesourcedb sky models
+    ms_freqs : list
+        Frequencies in Hz of the sky models
+    w : WCS object
+        WCS of the model images
+    freqs : array
+        Sorted frequencies of the model images in Hz
+    pixels, fluxes, masks, shape
+        Component table of the model images (see read_components())
+    min_flux_jy : float, optional
+        Minimum value of flux in Jy of a source to include in output model
+    interp : str, optional
+        Interpolation method (see main())
+
+    Returns
+    -------
+    failed : dict
+        Error message of each sky model that could not be written (the others
+        are written nevertheless)
+
+    """
+    # Find nonzero pixels in stacked image
+    stacked_model = np.zeros(len(pixels))
+    stacked_mask = np.zeros(len(pixels))
+    for im, ma in zip(fluxes, masks):
+        stacked_model += im
+        stacked_mask += ma
+    nonzero = np.where((stacked_model != 0.0) & (stacked_mask > 0))[0]
+
+    # Interpolate the fluxes to the frequencies of the MSs
+    flux, ok = interpolate_fluxes(freqs, fluxes[:, nonzero], masks[:, nonzero] > 0,
+                                  np.array(ms_freqs), interp)
+    accepted = ok & (flux > min_flux_jy)
+
+    # Get the positions of all sources that are used in any sky model at once
+    used = np.where(np.any(accepted, axis=0))[0]
+    radec_str = []
+    if len(used) > 0:
+        pixel_ind = np.array(np.unravel_index(pixels[nonzero[used]], shape))
+        radec = w.wcs_pix2world(pixel_ind[::-1].transpose(), 0, ra_dec_order=True) # WCS coords
+        radec_str = [convert_radec_str(ra, dec) for ra, dec in radec[:, 0:2]]
+    used_ind = np.zeros(len(nonzero), dtype=int)
+    used_ind[used] = np.arange(len(used))
+
+    # Write sky models
+    failed = {}
+    for skymodel, ms_freq, band_flux, band_accepted in zip(skymodels, ms_freqs, flux, accepted):
+        lines = ['FORMAT = Name, Type, Ra, Dec, I, Q, U, V, ReferenceFrequency\n']
+        for i in np.where(band_accepted)[0]:
+            ra_str, dec_str = radec_str[used_ind[i]]
+            lines.append('cc{0}, POINT, {1}, {2}, {3}, 0.0, 0.0, 0.0, {4}\n'
+                .format(i, ra_str, dec_str, band_flux[i], ms_freq))
+        try:
+            with open(skymodel, 'w') as outfile:
+                outfile.write(''.join(lines))
+        except (IOError, OSError) as e:
+            failed[skymodel] = str(e)
+    return failed
+
+
+def make_skymodels(fits_models, fits_masks, bands, skymodels, min_flux_jy=0.005,
+                   interp='linear'):
+    """
+    Make makesourcedb sky models for several bands from one read of the model
+    images
+
+    The components of all model images that are needed are read once, and the
+    sky models of all bands that use the same model images are evaluated at
+    once.
+
+    Parameters
+    ----------
+    fits_models : list
+        Filenames of FITS model images
+    fits_masks : list
+        Filenames of FITS mask images (same order as fits_models)
+    bands : list
+        Frequency, lowest and highest frequency in Hz of each band (see
+        get_band()). For a plain target frequency freq use (freq, freq, freq)
+    skymodels : list
+        Filenames of the output makesourcedb sky models, one per band
+    min_flux_jy : float, optional
+        Minimum value of flux in Jy of a source to include in output model
+    interp : str, optional
+        Interpolation method (see main())
+
+    Returns
+    -------
+    failed : dict
+        Error message of each sky model that could not be made or written
+        (the others are made nevertheless)
+
+    """
+    # Get frequencies of model images
+    freqs = []
+    for f in fits_models:
+        hdr = fits.getheader(f, 0)
+        freqs.append(hdr['CRVAL3']) # Hz
+
+    # Sort by freq
+    sorted_ind = np.argsort(freqs)
+    freqs = np.array(freqs)[sorted_ind]
+    fits_models = np.array(fits_models)[sorted_ind]
+    fits_masks = np.array(fits_masks)[sorted_ind]
+
+    # Check if there is a model at the ms frequency. If so, just use that one.
+    # Bands that use the same models are done together
+    groups = {}
+    for skymodel, (ms_freq, ms_freq_low, ms_freq_high) in zip(skymodels, bands):
+        ind = np.where( np.logical_and(freqs >= ms_freq_low, freqs <= ms_freq_high) )[0]
+        if len(ind) != 1:
+            ind = np.arange(len(freqs))
+        groups.setdefault(tuple(ind), []).append((skymodel, ms_freq))
+
+    if not groups:
+        return {}
+
+    # Read the components of all models that are used
+    needed = np.unique(np.concatenate([list(ind) for ind in groups]))
+    pixels, fluxes, masks, shape = read_components(fits_models[needed], fits_masks[needed])
+
+    failed = {}
+    for ind, group in groups.items():
+        rows = np.searchsorted(needed, ind)
+
+        # Set the WCS reference
+        hdr = fits.getheader(fits_models[ind[0]], 0)
+        w = wcs.WCS(hdr)
+
+        # A group that cannot be made (e.g. too few frequencies for the
+        # interpolation of some components) is made band by band, so that only
+        # the bands concerned fail, as when every band was made on its own
+        batches = [group]
+        while batches:
+            batch = batches.pop()
+            try:
+                failed.update(write_skymodels([skymodel for skymodel, ms_freq in batch],
+                                              [ms_freq for skymodel, ms_freq in batch], w, freqs[list(ind)],
+                                              pixels, fluxes[rows], masks[rows], shape, min_flux_jy, interp))
+            except Exception as e:
+                if len(batch) > 1:
+                    batches.extend([band] for band in batch)
+                else:
+                    failed[batch[0][0]] = str(e)
+    return failed
+
+
 def main(fits_models, ms_file, skymodel, fits_masks, min_flux_jy=0.005, interp='linear'):
     """
     Make a makesourcedb sky model for input MS from WSClean fits model images
@@ -90,96 +405,11 @@ def main(fits_models, ms_file, skymodel, fits_masks, min_flux_jy=0.005, interp='
         fits_masks = [fits_masks.strip('\'\" ')]
 
     # Read (first) MS file and get the frequency info
-    if '[' in ms_file and ']' in ms_file:
-        files = ms_file.strip('[] ').split(',')
-        #files = [f.strip() for f in files]
-        ms_file = files[0].strip('\'\" ')
-    sw = pt.table(ms_file+'::SPECTRAL_WINDOW', ack=False)
-    ms_freq = sw.col('REF_FREQUENCY')[0]
-    ms_freq_low = sw.col('CHAN_FREQ')[0][0]
-    ms_freq_high = sw.col('CHAN_FREQ')[0][-1]
-    sw.close()
-
-    # Get frequencies and data of model images and masks
-    freqs = []
-    model_images = []
-    mask_images = []
-    for f in fits_models:
-        hdr = fits.getheader(f, 0)
-        freqs.append(hdr['CRVAL3']) # Hz
-        model_images.append(fits.getdata(f, 0))
-    for f in fits_masks:
-        mask_images.append(fits.getdata(f, 0))
-
-    # Sort by freq
-    sorted_ind = np.argsort(freqs)
-    freqs = np.array(freqs)[sorted_ind]
-    fits_models = np.array(fits_models)[sorted_ind]
-    model_images = np.array(model_images)[sorted_ind]
-    mask_images = np.array(mask_images)[sorted_ind]
+    band = get_band(ms_file)
 
-    # Check if there is a model at the ms frequency. If so, just use that one
-    ind = np.where( np.logical_and(freqs >= ms_freq_low, freqs <= ms_freq_high) )
-    if len(ind[0]) == 1:
-        freqs = freqs[ind]
-        fits_models = fits_models[ind]
-        model_images = model_images[ind]
-        mask_images = mask_images[ind]
-
-    # Set the WCS reference
-    hdr = fits.getheader(fits_models[0], 0)
-    w = wcs.WCS(hdr)
-
-    # Find nonzero pixels in stacked image
-    stacked_model = np.zeros(model_images[0].shape)
-    stacked_mask = np.zeros(mask_images[0].shape)
-    for im, ma in zip(model_images, mask_images):
-        stacked_model += im
-        stacked_mask += ma
-    nonzero_ind = np.where((stacked_model != 0.0) & (stacked_mask > 0))
-
-    # Interpolate the fluxes to the frequency of the MS
-    nsources = len(nonzero_ind[0])
-    fluxes = []
-    names = []
-    ras = []
-    decs = []
-    for i in range(nsources):
-        flux_array = []
-        freq_array = []
-        for ind, (im, ma) in enumerate(zip(model_images, mask_images)):
-            index = [nonzero_ind[j][i] for j in range(4)]
-            if ma[tuple(index)] > 0:
-                flux_array.append(im[tuple(index)])
-                freq_array.append(freqs[ind])
-
-        if len(flux_array) > 0:
-            # Only create a source entry if MS frequency is within +/- 4 MHz of
-            # the sampled frequency range to prevent large extrapolations when
-            # the primary beam may cause rapid spectral changes
-            if ms_freq > freq_array[0]-4e6 and ms_freq < freq_array[-1]+4e6:
-                # If MS frequency lies outside range, just use nearest freq
-                if ms_freq < freq_array[0]:
-                    flux = flux_array[0]
-                elif ms_freq > freq_array[-1]:
-                    flux = flux_array[-1]
-                else:
-                    # Otherwise interpolate
-                    flux = scipy.interpolate.interp1d(freq_array, flux_array, kind=interp)(ms_freq)
-                if flux > min_flux_jy:
-                    index.reverse() # change to WCS coords
-                    ras.append(w.wcs_pix2world(np.array([index]), 0, ra_dec_order=True)[0][0])
-                    decs.append(w.wcs_pix2world(np.array([index]), 0, ra_dec_order=True)[0][1])
-                    names.append('cc{}'.format(i))
-                    fluxes.append(flux)
-
-    # Write sky model
-    with open(skymodel, 'w') as outfile:
-        outfile.write('FORMAT = Name, Type, Ra, Dec, I, Q, U, V, ReferenceFrequency\n')
-        for name, ra, dec, flux in zip(names, ras, decs, fluxes):
-            ra_str, dec_str = convert_radec_str(ra, dec)
-            outfile.write('{0}, POINT, {1}, {2}, {3}, 0.0, 0.0, 0.0, {4}\n'
-                .format(name, ra_str, dec_str, flux, ms_freq))
+    failed = make_skymodels(fits_models, fits_masks, [band], [skymodel], min_flux_jy, interp)
+    if skymodel in failed:
+        raise RuntimeError('Cannot make sky model {0}: {1}'.format(skymodel, failed[skymodel]))
 
 
 if __name__ == '__main__':
@@ -7,7 +7,11 @@ from argparse import RawTextHelpFormatter
 import casacore.images as pim
 from astropy.io import fits as pyfits
 from astropy.coordinates import Angle
+from astropy.wcs import WCS
+import astropy.units as u
 import pickle
+import hashlib
+import tempfile
 import numpy as np
 import sys
 import os
@@ -189,6 +193,108 @@ class Polygon:
         return mindst
 
 
+    def rasterize(self, shape, boundary=True, smalld=1e-12, chunksize=1024):
+        """
+        Return a mask of the pixels inside the polygon
+
+        The mask is made with a scanline fill: for each row of pixels (constant
+        x) the crossings with the sides of the polygon are found and the pixels
+        between pairs of crossings are set (even-odd rule). Only the rows
+        within the bounding box of the polygon are processed. No distances are
+        computed. Note that this can differ from the sign of is_inside(), which
+        gets the wrong side for some pixels of some polygons.
+
+        Parameters
+        ----------
+        shape : tuple of ints
+            Shape (nx, ny) of the mask. Pixel (i, j) has the coords x = i, y = j
+        boundary : bool, optional
+            Value of the pixels on a side of the polygon (for which is_inside()
+            returns 0)
+        smalld : float, optional
+            Tolerance within which a pixel is considered to be on a side
+        chunksize : int, optional
+            Number of rows processed at once
+
+        Returns
+        -------
+        mask : array of bool
+            True for the pixels inside the polygon
+
+        """
+        nx, ny = shape
+        mask = np.zeros((nx, ny), dtype=bool)
+        x1 = self.x[:-1]
+        y1 = self.y[:-1]
+        x2 = self.x[1:]
+        y2 = self.y[1:]
+        xmin = max(int(np.ceil(np.min(self.x) - smalld)), 0)
+        xmax = min(int(np.floor(np.max(self.x) + smalld)), nx - 1)
+
+        for start in range(xmin, xmax + 1, chunksize):
+            rows = np.arange(start, min(start + chunksize, xmax + 1))
+            xrow = rows[:, np.newaxis].astype(float)
+
+            # Find the crossings of the sides with the rows (a side includes
+            # its start and excludes its end, so that every vertex is counted
+            # once)
+            row, side = np.nonzero((x1 > xrow) != (x2 > xrow))
+            ycross = (y1[side] + (xrow[row, 0] - x1[side]) *
+                      (y2[side] - y1[side]) / (x2[side] - x1[side]))
+
+            # The inside/outside state flips after each crossing
+            flip = np.zeros((len(rows), ny + 1), dtype=np.uint8)
+            np.add.at(flip, (row, np.clip(np.floor(ycross) + 1, 0, ny).astype(int)), 1)
+            mask[rows] = np.cumsum(flip[:, :ny], axis=1, dtype=np.uint8) & 1 == 1
+
+            # Crossings on a pixel
+            ypix = np.round(ycross)
+            onside = (np.fabs(ycross - ypix) < smalld) & (ypix >= 0) & (ypix < ny)
+            mask[rows[row[onside]], ypix[onside].astype(int)] = boundary
+
+        # Sides along a row of pixels
+        for i in range(len(x1)):
+            if x1[i] == x2[i] and np.fabs(x1[i] - np.round(x1[i])) < smalld:
+                xpix = int(np.round(x1[i]))
+                if 0 <= xpix < nx:
+                    ylow = max(int(np.ceil(min(y1[i], y2[i]) - smalld)), 0)
+                    yhigh = min(int(np.floor(max(y1[i], y2[i]) + smalld)), ny - 1)
+                    if ylow <= yhigh:
+                        mask[xpix, ylow:yhigh+1] = boundary
+
+        # Vertices on a pixel
+        xpix = np.round(x1)
+        ypix = np.round(y1)
+        onvertex = ((np.fabs(x1 - xpix) < smalld) & (np.fabs(y1 - ypix) < smalld) &
+                    (xpix >= 0) & (xpix < nx) & (ypix >= 0) & (ypix < ny))
+        mask[xpix[onvertex].astype(int), ypix[onvertex].astype(int)] = boundary
+
+        return mask
+
+
+def _det(xvert, yvert):
+    """
+    Compute twice the area of the triangle defined by points with using
+    determinant formula.
+
+    Parameters
+    ----------
+    xvert : array
+        A vector of nodal x-coords (array-like).
+    yvert : array
+        A vector of nodal y-coords (array-like).
+
+    Returns
+    -------
+    Twice the area of the triangle defined by the points.
+
+    """
+    xvert = np.asfarray(xvert)
+    yvert = np.asfarray(yvert)
+    x_prev = np.concatenate(([xvert[-1]], xvert[:-1]))
+    y_prev = np.concatenate(([yvert[-1]], yvert[:-1]))
+    return np.sum(yvert * x_prev - xvert * y_prev, axis=0)
+
 
 def read_vertices(filename):
     """
@@ -199,18 +305,94 @@ def read_vertices(filename):
     return direction_dict['vertices']
 
 
-def read_casa_polys(filename, image):
+# cache of the parsed CASA region files and of their polygons in pixel
+# coordinates (see read_casa_polys())
+_casa_regions_cache = {}
+_casa_polys_cache = {}
+
+
+def image_wcs(image):
     """
-    Reads casa region file and returns polys
+    Returns an astropy WCS of the direction axes of a casacore image
+    """
+    dc = image.coordinates()['direction']
+    units = [u.Unit(unit).to('deg') for unit in dc.get_unit()]
+    refval = np.array(dc.get_referencevalue()) * units # [Dec, RA]
+    refpix = np.array(dc.get_referencepixel())
+    incr = np.array(dc.get_increment()) * units
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---' + dc.get_projection(), 'DEC--' + dc.get_projection()]
+    wcs.wcs.crval = [refval[1], refval[0]]
+    wcs.wcs.crpix = [refpix[1] + 1.0, refpix[0] + 1.0]
+    wcs.wcs.cdelt = [incr[1], incr[0]]
+    return wcs
+
+
+def topixel(image, ra, dec):
+    """
+    Returns the pixel coords of one position (RA and Dec in deg) in an image
+    """
+    try:
+        pixels = image.topixel([0, 1, dec*np.pi/180.0, ra*np.pi/180.0])
+    except:
+        pixels = image.topixel([1, 1, dec*np.pi/180.0, ra*np.pi/180.0])
+    return pixels[2], pixels[3] # x -> Dec, y -> RA
+
+
+def world_to_pixel(image, ra, dec):
+    """
+    Converts arrays of positions to pixel coords of an image at once
+
+    The conversion uses an astropy WCS built from the coordinate system of the
+    image. If that does not reproduce the conversion of casacore for the first
+    position, casacore is used for all positions.
+
+    Parameters
+    ----------
+    image : casacore image
+        Image that defines the pixel coords
+    ra : array
+        RA of the positions in deg
+    dec : array
+        Dec of the positions in deg
 
-    Note: only regions of type "poly" are supported
+    Returns
+    -------
+    x, y : arrays
+        Pixel coords of the positions (x -> Dec, y -> RA)
+
+    """
+    ra = np.atleast_1d(np.asfarray(ra))
+    dec = np.atleast_1d(np.asfarray(dec))
+    ypix, xpix = image_wcs(image).wcs_world2pix(ra, dec, 0)
+    xcheck, ycheck = topixel(image, ra[0], dec[0])
+    if abs(xpix[0] - xcheck) > 1e-3 or abs(ypix[0] - ycheck) > 1e-3:
+        pixels = [topixel(image, r, d) for r, d in zip(ra, dec)]
+        xpix = np.array([p[0] for p in pixels])
+        ypix = np.array([p[1] for p in pixels])
+    return xpix, ypix
+
+
+def parse_casa_regions(filename):
+    """
+    Reads casa region file and returns the regions in world coords
+
+    Note: only regions of type "poly", "box" and "ellipse" (with position
+    angles of 0.0 or 90.0) are supported
+
+    Returns
+    -------
+    regions : list of tuples
+        (type, RA, Dec, parameters) with the vertices (poly, box) or the
+        center (ellipse) in deg. The parameters of an ellipse are the
+        semimajor and semiminor axes in deg and the position angle
     """
     with open(filename, 'r') as f:
         lines = f.readlines()
 
-    polys = []
+    regions = []
     for line in lines:
-        if line.startswith('poly'):
+        if line.startswith('poly') or line.startswith('box'):
             poly_str_temp = line.split('[[')[1]
             poly_str = poly_str_temp.split(']]')[0]
             poly_str_list = poly_str.split('], [')
@@ -220,21 +402,12 @@ def read_casa_polys(filename, image):
                 RAstr, Decstr = pos.split(',')
                 ra.append(Angle(RAstr, unit='hourangle').to('deg').value)
                 dec.append(Angle(Decstr.replace('.', ':', 2), unit='deg').to('deg').value)
-            poly_vertices = [np.array(ra), np.array(dec)]
-
-            # Convert to image-plane polygon
-            xvert = []
-            yvert = []
-            for RAvert, Decvert in zip(np.array(ra), np.array(dec)):
-                try:
-                    pixels = image.topixel([0, 1, Decvert*np.pi/180.0,
-                                               RAvert*np.pi/180.0])
-                except:
-                    pixels = image.topixel([1, 1, Decvert*np.pi/180.0,
-                                               RAvert*np.pi/180.0])
-                xvert.append(pixels[2]) # x -> Dec
-                yvert.append(pixels[3]) # y -> RA
-            polys.append(Polygon(xvert, yvert))
+            if line.startswith('box'):
+                ra.insert(1, ra[0])
+                dec.insert(1, dec[1])
+                ra.append(ra[2])
+                dec.append(dec[0])
+            regions.append(('poly', np.array(ra), np.array(dec), None))
 
         elif line.startswith('ellipse'):
             ell_str_temp = line.split('[[')[1]
@@ -254,66 +427,13 @@ def read_casa_polys(filename, image):
             RAstr, Decstr = ell_str_list[0].split(',')
             ra_center = Angle(RAstr, unit='hourangle').to('deg').value
             dec_center = Angle(Decstr.replace('.', ':', 2), unit='deg').to('deg').value
-            pixels = image.topixel([0, 1, dec_center*np.pi/180.0,
-                ra_center*np.pi/180.0])
-            x_center = pixels[2] # x -> Dec
-            y_center = pixels[3] # y -> RA
 
             # Ellipse semimajor and semiminor axes
             a_str, b_str = ell_str_list[1].split(',')
             a_deg = float(a_str.split('arcsec')[0])/3600.0
             b_deg = float(b_str.split('arcsec')[0])/3600.0
-            pixels1 = image.topixel([0, 1, (dec_center-a_deg/2.0)*np.pi/180.0,
-                ra_center*np.pi/180.0])
-            a_pix1 = pixels1[2]
-            pixels2 = image.topixel([0, 1, (dec_center+a_deg/2.0)*np.pi/180.0,
-                ra_center*np.pi/180.0])
-            a_pix2 = pixels2[2]
-            a_pix = abs(a_pix2 - a_pix1)
-            ex = []
-            ey = []
-            for th in range(0, 360, 1):
-                if pa == 0:
-                    # semimajor axis is along x-axis
-                    ex.append(a_pix * np.cos(th * np.pi / 180.0)
-                        + x_center) # x -> Dec
-                    ey.append(a_pix * b_deg / a_deg * np.sin(th * np.pi / 180.0) + y_center) # y -> RA
-                elif pa == 90:
-                    # semimajor axis is along y-axis
-                    ex.append(a_pix * b_deg / a_deg * np.cos(th * np.pi / 180.0)
-                        + x_center) # x -> Dec
-                    ey.append(a_pix * np.sin(th * np.pi / 180.0) + y_center) # y -> RA
-            polys.append(Polygon(ex, ey))
-
-        elif line.startswith('box'):
-            poly_str_temp = line.split('[[')[1]
-            poly_str = poly_str_temp.split(']]')[0]
-            poly_str_list = poly_str.split('], [')
-            ra = []
-            dec = []
-            for pos in poly_str_list:
-                RAstr, Decstr = pos.split(',')
-                ra.append(Angle(RAstr, unit='hourangle').to('deg').value)
-                dec.append(Angle(Decstr.replace('.', ':', 2), unit='deg').to('deg').value)
-            ra.insert(1, ra[0])
-            dec.insert(1, dec[1])
-            ra.append(ra[2])
-            dec.append(dec[0])
-            poly_vertices = [np.array(ra), np.array(dec)]
-
-            # Convert to image-plane polygon
-            xvert = []
-            yvert = []
-            for RAvert, Decvert in zip(np.array(ra), np.array(dec)):
-                try:
-                    pixels = image.topixel([0, 1, Decvert*np.pi/180.0,
-                                               RAvert*np.pi/180.0])
-                except:
-                    pixels = image.topixel([1, 1, Decvert*np.pi/180.0,
-                                               RAvert*np.pi/180.0])
-                xvert.append(pixels[2]) # x -> Dec
-                yvert.append(pixels[3]) # y -> RA
-            polys.append(Polygon(xvert, yvert))
+            regions.append(('ellipse', np.array([ra_center]), np.array([dec_center]),
+                            (a_deg, b_deg, pa)))
 
         elif line.startswith('#'):
             pass
@@ -322,9 +442,222 @@ def read_casa_polys(filename, image):
             print('Only CASA regions of type "poly", "box", or "ellipse" are supported')
             sys.exit(1)
 
+    return regions
+
+
+def read_casa_polys(filename, image):
+    """
+    Reads casa region file and returns polys
+
+    The region file is parsed once and the polygons are cached for each
+    coordinate system, so that repeated calls (e.g., for the masks of several
+    frequency bands) only convert the vertices once. All vertices of a file
+    are converted to pixel coords at once.
+
+    Note: only regions of type "poly", "box" and "ellipse" are supported
+    """
+    mtime = os.path.getmtime(filename)
+    file_key = (os.path.abspath(filename), mtime)
+    if file_key not in _casa_regions_cache:
+        _casa_regions_cache[file_key] = parse_casa_regions(filename)
+    regions = _casa_regions_cache[file_key]
+
+    wcs = image_wcs(image)
+    key = file_key + (tuple(wcs.wcs.ctype), tuple(wcs.wcs.crval), tuple(wcs.wcs.crpix),
+                      tuple(wcs.wcs.cdelt))
+    if key in _casa_polys_cache:
+        return _casa_polys_cache[key]
+
+    # Convert all vertices to image-plane coords at once (for an ellipse the
+    # center and the ends of the major axis along Dec)
+    ra = []
+    dec = []
+    for region_type, region_ra, region_dec, pars in regions:
+        if region_type == 'poly':
+            ra.extend(region_ra)
+            dec.extend(region_dec)
+        else:
+            a_deg = pars[0]
+            ra.extend([region_ra[0]] * 3)
+            dec.extend([region_dec[0], region_dec[0]-a_deg/2.0, region_dec[0]+a_deg/2.0])
+    if len(ra) > 0:
+        xpix, ypix = world_to_pixel(image, ra, dec)
+
+    polys = []
+    i = 0
+    for region_type, region_ra, region_dec, pars in regions:
+        if region_type == 'poly':
+            n = len(region_ra)
+            polys.append(Polygon(xpix[i:i+n], ypix[i:i+n]))
+            i += n
+        else:
+            a_deg, b_deg, pa = pars
+            x_center = xpix[i] # x -> Dec
+            y_center = ypix[i] # y -> RA
+            a_pix = abs(xpix[i+2] - xpix[i+1])
+            i += 3
+            th = np.arange(0, 360, 1) * np.pi / 180.0
+            if pa == 0:
+                # semimajor axis is along x-axis
+                ex = a_pix * np.cos(th) + x_center # x -> Dec
+                ey = a_pix * b_deg / a_deg * np.sin(th) + y_center # y -> RA
+            else:
+                # semimajor axis is along y-axis
+                ex = a_pix * b_deg / a_deg * np.cos(th) + x_center # x -> Dec
+                ey = a_pix * np.sin(th) + y_center # y -> RA
+            polys.append(Polygon(ex, ey))
+
+    _casa_polys_cache[key] = polys
     return polys
 
 
+def read_facet_polygon(filename, image):
+    """
+    Returns the facet polygon stored in input file in pixel coordinates of an
+    image
+    """
+    vertices = read_vertices(filename)
+    xvert, yvert = world_to_pixel(image, vertices[0], vertices[1])
+    return Polygon(xvert, yvert)
+
+
+def blank_image(image_name, vertices_file):
+    """
+    Writes a copy of an image with the regions outside of the facet blanked
+
+    A FITS image is read and written once with astropy; a CASA image is copied
+    first and then changed in place.
+
+    Parameters
+    ----------
+    image_name : str
+        Filename of input image
+    vertices_file : str
+        Filename of file with the facet vertices
+
+    Returns
+    -------
+    blanked_name : str
+        Filename of the blanked image
+
+    """
+    blanked_name = image_name + '.blanked'
+    input_img = pim.image(image_name)
+    poly = read_facet_polygon(vertices_file, input_img)
+    if os.path.isfile(image_name):
+        del(input_img)
+        hdulist = pyfits.open(image_name)
+        data = hdulist[0].data
+    else:
+        input_img.saveas(blanked_name, overwrite=True)
+        input_img = pim.image(blanked_name)
+        data = input_img.getdata()
+
+    # Set to NaN the masked regions that are outside the facet
+    outside = ~poly.rasterize(data.shape[2:]) & (data[0, 0] != 0)
+    data[0, 0][outside] = np.nan
+
+    if os.path.isfile(image_name):
+        hdulist.writeto(blanked_name, clobber=True)
+        hdulist.close()
+    else:
+        input_img.putdata(data)
+    return blanked_name
+
+
+def island_mask(img):
+    """
+    Returns the island mask of a PyBDSF image object (1 = inside island) in the
+    pixel order of the input image, i.e., the mask that PyBDSF would write
+    with export_image(img_type='island_mask', mask_dilation=0)
+    """
+    return np.array((img.pyrank + 1 > 0).transpose(), dtype=np.float32)
+
+
+def pad_mask(data, coordsys, imsize):
+    """
+    Returns a mask padded to a size of imsize x imsize, with the reference
+    pixel of the coordinate system moved accordingly
+    """
+    coordsys['direction'].set_referencepixel([imsize/2, imsize/2])
+    pixmin = (imsize - data.shape[2]) / 2
+    if pixmin < 0:
+        print("The padded size must be larger than the original size.")
+        sys.exit(1)
+    pixmax = pixmin + data.shape[2]
+    data_pad = np.zeros((1, 1, imsize, imsize), dtype=np.float32)
+    data_pad[0, 0, pixmin:pixmax, pixmin:pixmax] = data[0, 0]
+    return data_pad
+
+
+def trim_mask(data, trim_by):
+    """
+    Zeroes the perimeter of a mask, trim_by is the fraction of the image size
+    """
+    sh = np.shape(data)
+    margin = int(sh[2] * trim_by / 2.0 )
+    data[0, 0, 0:sh[2], 0:margin] = 0
+    data[0, 0, 0:margin, 0:sh[3]] = 0
+    data[0, 0, 0:sh[2], sh[3]-margin:sh[3]] = 0
+    data[0, 0, sh[2]-margin:sh[2], 0:sh[3]] = 0
+
+
+def get_rmsmean_maps(image_name, cache_dir, bdsf_opts, threshpix, threshisl):
+    """
+    Returns the filenames of the background mean and rms maps of an image
+
+    The maps are computed with PyBDSF (up to the island detection) and stored
+    as FITS files in the cache directory, keyed by the image and the PyBDSF
+    options that determine the maps. Later PyBDSF runs on the same image can
+    use them through the rmsmean_map_filename option instead of computing them
+    again, as the maps do not depend on the detection thresholds.
+
+    Parameters
+    ----------
+    image_name : str
+        Filename of input image
+    cache_dir : str
+        Directory of the cached maps
+    bdsf_opts : dict
+        PyBDSF options (without the thresholds)
+    threshpix : float
+        Value of thresh_pix PyBDSF parameter
+    threshisl : float
+        Value of thresh_isl PyBDSF parameter
+
+    Returns
+    -------
+    maps : list of str
+        Filenames of the mean and rms maps [mean_map, rms_map]
+    img : PyBDSF image object or None
+        Result of the island detection with the given thresholds if the maps
+        had to be computed (None if they were cached)
+
+    """
+    map_opts = [bdsf_opts[opt] for opt in ['mean_map', 'rms_box', 'rms_box_bright',
+                                           'adaptive_rms_box', 'adaptive_thresh']]
+    key = hashlib.md5(repr([os.path.abspath(image_name), os.path.getmtime(image_name),
+                            map_opts]).encode('utf-8')).hexdigest()
+    prefix = os.path.join(cache_dir, os.path.basename(image_name.rstrip('/')) + '_' + key)
+    maps = [prefix + '_mean.fits', prefix + '_rms.fits']
+    if os.path.exists(maps[0]) and os.path.exists(maps[1]):
+        print('Using cached background mean and rms maps {0}'.format(prefix))
+        return maps, None
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    img = bdsf.process_image(image_name, thresh_pix=threshpix, thresh_isl=threshisl,
+                             stop_at='isl', **bdsf_opts)
+    for img_type, map_name in zip(['mean', 'rms'], maps):
+        # write to a temporary file first, so that a crash never leaves a
+        # partial map in the cache
+        fd, tmpname = tempfile.mkstemp(dir=cache_dir, suffix='.fits')
+        os.close(fd)
+        img.export_image(img_type=img_type, outfile=tmpname, img_format='fits', clobber=True)
+        os.rename(tmpname, map_name)
+    return maps, img
+
+
 def make_template_image(image_name, reference_ra_deg, reference_dec_deg,
     imsize=512, cellsize_deg=0.000417):
     """
@@ -395,7 +728,8 @@ def main(image_name, mask_name, atrous_do=False, threshisl=0.0, threshpix=0.0, r
          threshold_format='float', trim_by=0.0, vertices_file=None, atrous_jmax=6,
          pad_to_size=None, skip_source_detection=False, region_file=None, nsig=1.0,
          reference_ra_deg=None, reference_dec_deg=None, cellsize_deg=0.000417,
-         use_adaptive_threshold=False, adaptive_thresh=150.0):
+         use_adaptive_threshold=False, adaptive_thresh=150.0, reuse_rmsmap=True,
+         rmsmap_cache_dir=None):
     """
     Make a clean mask and return clean threshold
 
@@ -455,6 +789,13 @@ def main(image_name, mask_name, atrous_do=False, threshisl=0.0, threshpix=0.0, r
     adaptive_thresh : float, optional
         If adaptive_rmsbox is True, this value sets the threshold above
         which a source will use the small rms box
+    reuse_rmsmap : bool, optional
+        If True, the background mean and rms maps are computed only once and
+        reused by all PyBDSF runs of iterate_threshold and
+        use_adaptive_threshold
+    rmsmap_cache_dir : str, optional
+        Directory of the cached background maps (default: rmsmap_cache in the
+        directory of the output mask)
 
     Returns
     -------
@@ -502,6 +843,15 @@ def main(image_name, mask_name, atrous_do=False, threshisl=0.0, threshpix=0.0, r
         else:
             use_adaptive_threshold = False
 
+    if type(reuse_rmsmap) is str:
+        if reuse_rmsmap.lower() == 'true':
+            reuse_rmsmap = True
+        else:
+            reuse_rmsmap = False
+
+    if rmsmap_cache_dir is None:
+        rmsmap_cache_dir = os.path.join(os.path.dirname(os.path.abspath(mask_name)), 'rmsmap_cache')
+
     if reference_ra_deg is not None and reference_dec_deg is not None:
         reference_ra_deg = float(reference_ra_deg)
         reference_dec_deg = float(reference_dec_deg)
@@ -529,46 +879,26 @@ def main(image_name, mask_name, atrous_do=False, threshisl=0.0, threshpix=0.0, r
 
     if not skip_source_detection:
         if vertices_file is not None:
-            # Modify the input image to blank the regions outside of the polygon
-            temp_img = pim.image(image_name)
-            image_name += '.blanked'
-            temp_img.saveas(image_name, overwrite=True)
-            input_img = pim.image(image_name)
-            data = input_img.getdata()
-
-            vertices = read_vertices(vertices_file)
-            RAverts = vertices[0]
-            Decverts = vertices[1]
-            xvert = []
-            yvert = []
-            for RAvert, Decvert in zip(RAverts, Decverts):
-                pixels = input_img.topixel([1, 1, Decvert*np.pi/180.0,
-                    RAvert*np.pi/180.0])
-                xvert.append(pixels[2]) # x -> Dec
-                yvert.append(pixels[3]) # y -> RA
-            poly = Polygon(xvert, yvert)
-
-            # Find masked regions
-            masked_ind = np.where(data[0, 0])
-
-            # Find distance to nearest poly edge and set to NaN those that
-            # are outside the facet (dist < 0)
-            dist = poly.is_inside(masked_ind[0], masked_ind[1])
-            outside_ind = np.where(dist < 0.0)
-            if len(outside_ind[0]) > 0:
-                data[0, 0, masked_ind[0][outside_ind], masked_ind[1][outside_ind]] = np.nan
-
-            # Save changes
-            input_img.putdata(data)
+            # Blank the regions outside of the polygon in a copy of the input image
+            image_name = blank_image(image_name, vertices_file)
+
+        bdsf_opts = dict(mean_map='zero', rms_box=rmsbox, atrous_do=atrous_do,
+                         ini_method='curvature', thresh='hard',
+                         adaptive_rms_box=adaptive_rmsbox, adaptive_thresh=adaptive_thresh,
+                         rms_box_bright=rmsbox_bright, rms_map=True, quiet=True,
+                         atrous_jmax=atrous_jmax)
+        img = None
+        if reuse_rmsmap and (use_adaptive_threshold or iterate_threshold):
+            # All runs below share the background maps, so compute them once
+            # (the island detection done for that is reused if possible)
+            bdsf_opts['rmsmean_map_filename'], img = get_rmsmean_maps(image_name, rmsmap_cache_dir,
+                                                                      bdsf_opts, threshpix, threshisl)
 
         if use_adaptive_threshold:
             # Get an estimate of the rms
-            img = bdsf.process_image(image_name, mean_map='zero', rms_box=rmsbox,
-                                     thresh_pix=threshpix, thresh_isl=threshisl,
-                                     atrous_do=atrous_do, ini_method='curvature', thresh='hard',
-                                     adaptive_rms_box=adaptive_rmsbox, adaptive_thresh=adaptive_thresh,
-                                     rms_box_bright=rmsbox_bright, rms_map=True, quiet=True,
-                                     atrous_jmax=atrous_jmax, stop_at='isl')
+            if img is None:
+                img = bdsf.process_image(image_name, thresh_pix=threshpix, thresh_isl=threshisl,
+                                         stop_at='isl', **bdsf_opts)
 
             # Find min and max pixels
             max_neg_val = abs(np.min(img.ch0_arr))
@@ -586,29 +916,38 @@ def main(image_name, mask_name, atrous_do=False, threshisl=0.0, threshpix=0.0, r
             # Use the new threshold only if it is larger than the user-specified one
             if threshisl_neg > threshisl:
                 threshisl = threshisl_neg
-
-        if iterate_threshold:
+                img = None
+
+        if iterate_threshold and reuse_rmsmap:
+            # Start with given threshold and lower it until we get at least one
+            # island, using the island detection only. Then do the full run
+            # with the threshold found
+            while True:
+                if img is None:
+                    img = bdsf.process_image(image_name, thresh_pix=threshpix, thresh_isl=threshisl,
+                                             stop_at='isl', **bdsf_opts)
+                if img.nisl > 0 or threshpix / 1.2 < 5.0:
+                    break
+                threshpix /= 1.2
+                threshisl /= 1.2
+                img = None
+            if img.nisl > 0:
+                img = bdsf.process_image(image_name, thresh_pix=threshpix, thresh_isl=threshisl,
+                                         **bdsf_opts)
+        elif iterate_threshold:
             # Start with given threshold and lower it until we get at least one island
             nisl = 0
             while nisl == 0:
-                img = bdsf.process_image(image_name, mean_map='zero', rms_box=rmsbox,
-                                         thresh_pix=threshpix, thresh_isl=threshisl,
-                                         atrous_do=atrous_do, ini_method='curvature', thresh='hard',
-                                         adaptive_rms_box=adaptive_rmsbox, adaptive_thresh=adaptive_thresh,
-                                         rms_box_bright=rmsbox_bright, rms_map=True, quiet=True,
-                                         atrous_jmax=atrous_jmax)
+                img = bdsf.process_image(image_name, thresh_pix=threshpix, thresh_isl=threshisl,
+                                         **bdsf_opts)
                 nisl = img.nisl
                 threshpix /= 1.2
                 threshisl /= 1.2
                 if threshpix < 5.0:
                     break
         else:
-            img = bdsf.process_image(image_name, mean_map='zero', rms_box=rmsbox,
-                                     thresh_pix=threshpix, thresh_isl=threshisl,
-                                     atrous_do=atrous_do, ini_method='curvature', thresh='hard',
-                                     adaptive_rms_box=adaptive_rmsbox, adaptive_thresh=adaptive_thresh,
-                                     rms_box_bright=rmsbox_bright, rms_map=True, quiet=True,
-                                     atrous_jmax=atrous_jmax)
+            img = bdsf.process_image(image_name, thresh_pix=threshpix, thresh_isl=threshisl,
+                                     **bdsf_opts)
 
         if img.nisl == 0:
             if region_file is None or region_file == '[]':
@@ -637,101 +976,48 @@ def main(image_name, mask_name, atrous_do=False, threshisl=0.0, threshpix=0.0, r
             # This is done to get around the need for quotes around strings in casapy scripts
             # 'casastr/' is removed by the generic pipeline
             return {'threshold_5sig': 'casastr/{0}Jy'.format(threshold)}
-    elif not skip_source_detection:
+    elif not (skip_source_detection or vertices_file is not None or trim_by > 0
+              or pad_to_size is not None or (region_file is not None and region_file != '[]')):
+        # Nothing to alter, let PyBDSF write the mask
         img.export_image(img_type='island_mask', mask_dilation=0, outfile=mask_name,
                          img_format=img_format, clobber=True)
-
-    if (vertices_file is not None or trim_by > 0 or pad_to_size is not None
-        or (region_file is not None and region_file != '[]')
-        or skip_source_detection):
-        # Alter the mask in various ways
+    else:
+        # Make the mask in memory and alter it in various ways before writing
+        # it once
+        template_im = pim.image(image_name)
+        coordsys = template_im.coordinates()
         if skip_source_detection:
-            # Read the image
-            mask_im = pim.image(image_name)
+            # Mask all pixels
+            data = np.ones(template_im.shape(), dtype=np.float32)
         else:
-            # Read the PyBDSF mask
-            mask_im = pim.image(mask_name)
-        data = mask_im.getdata()
-        coordsys = mask_im.coordinates()
+            data = island_mask(img).reshape(template_im.shape())
+        del(template_im)
         if reference_ra_deg is not None and reference_dec_deg is not None:
             values = coordsys.get_referencevalue()
             values[2][0] = reference_dec_deg/180.0*np.pi
             values[2][1] = reference_ra_deg/180.0*np.pi
             coordsys.set_referencevalue(values)
-        imshape = mask_im.shape()
-        del(mask_im)
 
         if pad_to_size is not None:
-            imsize = pad_to_size
-            coordsys['direction'].set_referencepixel([imsize/2, imsize/2])
-            pixmin = (imsize - imshape[2]) / 2
-            if pixmin < 0:
-                print("The padded size must be larger than the original size.")
-                sys.exit(1)
-            pixmax = pixmin + imshape[2]
-            data_pad = np.zeros((1, 1, imsize, imsize), dtype=np.float32)
-            data_pad[0, 0, pixmin:pixmax, pixmin:pixmax] = data[0, 0]
-            new_mask = pim.image('', shape=(1, 1, imsize, imsize), coordsys=coordsys)
-            new_mask.putdata(data_pad)
-        else:
-            new_mask = pim.image('', shape=imshape, coordsys=coordsys)
-            new_mask.putdata(data)
-
-        data = new_mask.getdata()
-
-        if skip_source_detection:
-            # Mask all pixels
-            data[:] = 1
+            data = pad_mask(data, coordsys, pad_to_size)
+        new_mask = pim.image('', shape=data.shape, coordsys=coordsys)
 
         if vertices_file is not None:
-            # Modify the clean mask to exclude regions outside of the polygon
-            vertices = read_vertices(vertices_file)
-            RAverts = vertices[0]
-            Decverts = vertices[1]
-            xvert = []
-            yvert = []
-            for RAvert, Decvert in zip(RAverts, Decverts):
-                try:
-                    pixels = new_mask.topixel([0, 1, Decvert*np.pi/180.0,
-                                               RAvert*np.pi/180.0])
-                except:
-                    pixels = new_mask.topixel([1, 1, Decvert*np.pi/180.0,
-                                               RAvert*np.pi/180.0])
-                xvert.append(pixels[2]) # x -> Dec
-                yvert.append(pixels[3]) # y -> RA
-            poly = Polygon(xvert, yvert)
-
-            # Find masked regions
-            masked_ind = np.where(data[0, 0])
-
-            # Find distance to nearest poly edge and unmask those that
-            # are outside the facet (dist < 0)
-            dist = poly.is_inside(masked_ind[0], masked_ind[1])
-            outside_ind = np.where(dist < 0.0)
-            if len(outside_ind[0]) > 0:
-                data[0, 0, masked_ind[0][outside_ind], masked_ind[1][outside_ind]] = 0
+            # Unmask the regions that are outside the facet
+            poly = read_facet_polygon(vertices_file, new_mask)
+            data[0, 0][~poly.rasterize(data.shape[2:])] = 0
 
         if trim_by > 0.0:
-            sh = np.shape(data)
-            margin = int(sh[2] * trim_by / 2.0 )
-            data[0, 0, 0:sh[2], 0:margin] = 0
-            data[0, 0, 0:margin, 0:sh[3]] = 0
-            data[0, 0, 0:sh[2], sh[3]-margin:sh[3]] = 0
-            data[0, 0, sh[2]-margin:sh[2], 0:sh[3]] = 0
+            trim_mask(data, trim_by)
 
         if region_file is not None and region_file != '[]':
             # Merge the CASA regions with the mask
             casa_polys = read_casa_polys(region_file.strip('[]"'), new_mask)
             for poly in casa_polys:
-                # Find unmasked regions
-                unmasked_ind = np.where(data[0, 0] == 0)
-
-                # Find distance to nearest poly edge and mask those that
-                # are inside the casa region (dist > 0)
-                dist = poly.is_inside(unmasked_ind[0], unmasked_ind[1])
-                inside_ind = np.where(dist > 0.0)
-                if len(inside_ind[0]) > 0:
-                    data[0, 0, unmasked_ind[0][inside_ind], unmasked_ind[1][inside_ind]] = 1
+                # Mask the unmasked regions that are inside the casa region
+                # (excluding its boundary)
+                inside = poly.rasterize(data.shape[2:], boundary=False) & (data[0, 0] == 0)
+                data[0, 0][inside] = 1
 
         # Save changes
         new_mask.putdata(data)
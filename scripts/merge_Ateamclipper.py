@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -* coding: utf-8 -*-
+
+"""
+Merges the clipping statistics of all subbands written by Ateamclipper.py into
+one table (NPZ file), sorted by frequency.
+
+The table contains the arrays:
+    msname     : names of the MSs
+    freq       : reference frequencies of the MSs
+    clipped_xx : additionally flagged percentage of the XX data
+    clipped_yy : additionally flagged percentage of the YY data
+    clipped    : additionally flagged percentage per channel and correlation
+                 (only if all MSs have the same number of channels)
+"""
+
+import argparse
+import glob
+import os
+import tempfile
+import numpy
+
+
+def main(record_dir='Ateamclipper', outfile='Ateamclipper.npz'):
+    """
+    Merge the records of Ateamclipper.py into one table
+
+    Parameters
+    ----------
+    record_dir : str, optional
+        Directory with the records of Ateamclipper.py (one file per MS)
+    outfile : str, optional
+        Name of the output table
+    """
+    msnames = []
+    freqs = []
+    clipped = []
+    for record in sorted(glob.glob(os.path.join(record_dir, '*.npz'))):
+        with numpy.load(record) as r:
+            msnames.append(str(r['msname'].astype(str)))
+            freqs.append(float(r['freq']))
+            clipped.append(r['clipped'])
+    if len(freqs) == 0:
+        raise ValueError('No records found in ' + record_dir)
+
+    order = numpy.argsort(freqs, kind='mergesort')
+    table = {'msname': numpy.array(msnames)[order],
+             'freq': numpy.array(freqs)[order],
+             'clipped_xx': numpy.array([numpy.mean(clipped[i][:,0]) for i in order]),
+             'clipped_yy': numpy.array([numpy.mean(clipped[i][:,3]) for i in order])}
+    if len(set([c.shape for c in clipped])) == 1:
+        table['clipped'] = numpy.array([clipped[i] for i in order])
+
+    # write to a temporary file first, so that a reader never sees a partial table
+    outdir = os.path.dirname(os.path.abspath(outfile))
+    fd, tmpname = tempfile.mkstemp(dir=outdir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        numpy.savez(f, **table)
+    os.rename(tmpname, outfile)
+    print('Merged ' + str(len(freqs)) + ' records into ' + outfile)
+    return(0)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Merges the clipping statistics of all subbands written by Ateamclipper.py into one table.')
+
+    parser.add_argument('record_dir', type=str,
+                        help='Directory with the records written by Ateamclipper.py.')
+    parser.add_argument('outfile', type=str,
+                        help='Output table (NPZ file).')
+
+    args = parser.parse_args()
+
+    main(record_dir = args.record_dir, outfile = args.outfile)
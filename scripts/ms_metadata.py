@@ -0,0 +1,267 @@
+#! /usr/bin/env python
+"""
+Cached access to the metadata of measurement sets
+
+The metadata of an MS are read once with casacore and stored as a small JSON
+file in a cache directory, keyed by the path and the modification time of the
+MS. All further calls for the same MS (from any step of the pipeline) read this
+file instead of opening the subtables of the MS again. The cache lives in the
+working directory of the pipeline, never next to the MS (which may be
+read-only or shared); if it cannot be written, the metadata are simply read
+without caching.
+
+Usage from another script in this directory:
+
+    sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+    from ms_metadata import get_ms_metadata
+"""
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+
+# bump this if the content of the cache entries changes
+cache_version = 3
+
+# entries that are returned as numpy arrays
+array_keys = ['chan_freq', 'chan_width', 'time_range', 'antenna_positions',
+              'dish_diameter', 'phase_dir']
+
+
+def _read_ms_metadata(ms):
+    """
+    Read the metadata of an MS with casacore
+
+    Parameters
+    ----------
+    ms : str
+        Filename of the MS
+
+    Returns
+    -------
+    metadata : dict
+        Metadata of the MS (JSON-serializable)
+    """
+    try:
+        import casacore.tables as pt
+    except ImportError:
+        import pyrap.tables as pt
+
+    metadata = {}
+    t = pt.table(ms, ack=False)
+    metadata['nrows'] = t.nrows()
+    if t.nrows() > 0:
+        metadata['first_time'] = float(t.getcell('TIME', 0))
+        metadata['interval'] = float(t.getcell('INTERVAL', 0))
+        metadata['last_time'] = float(t.getcell('TIME', t.nrows()-1))
+        first = t.getcol('TIME', 0, min(t.nrows(), 100000))
+        metadata['first_slot_rows'] = int(np.sum(first == first[0]))
+    else:
+        metadata['first_time'] = None
+        metadata['interval'] = None
+        metadata['last_time'] = None
+        metadata['first_slot_rows'] = 0
+    t.close()
+
+    sw = pt.table(ms+'::SPECTRAL_WINDOW', ack=False)
+    metadata['ref_freq'] = float(sw.col('REF_FREQUENCY')[0])
+    metadata['chan_freq'] = sw.col('CHAN_FREQ')[0].tolist()
+    metadata['chan_width'] = sw.col('CHAN_WIDTH')[0].tolist()
+    metadata['nchan'] = len(metadata['chan_width'])
+    metadata['total_bandwidth'] = float(sw.col('TOTAL_BANDWIDTH')[0])
+    sw.close()
+
+    obs = pt.table(ms+'::OBSERVATION', ack=False)
+    metadata['time_range'] = obs.col('TIME_RANGE')[0].tolist()
+    if 'LOFAR_TARGET' in obs.colnames():
+        metadata['target_name'] = str(obs.getcol('LOFAR_TARGET')['array'][0])
+    else:
+        metadata['target_name'] = None
+    obs.close()
+
+    ant = pt.table(ms+'::ANTENNA', ack=False)
+    metadata['antenna_names'] = [str(name) for name in ant.getcol('NAME')]
+    metadata['antenna_positions'] = ant.getcol('POSITION').tolist()
+    metadata['dish_diameter'] = ant.getcol('DISH_DIAMETER').tolist()
+    ant.close()
+
+    field = pt.table(ms+'::FIELD', ack=False)
+    metadata['phase_dir'] = field.getcol('PHASE_DIR')[0][0].tolist()
+    metadata['field_name'] = str(field.getcol('NAME')[0])
+    field.close()
+
+    return metadata
+
+
+def _ms_mtime(ms):
+    """
+    Return the modification time of an MS (of its table.dat if present)
+    """
+    tabledat = os.path.join(ms, 'table.dat')
+    if os.path.exists(tabledat):
+        return os.path.getmtime(tabledat)
+    return os.path.getmtime(ms)
+
+
+def _cache_filename(ms, cache_dir=None):
+    """
+    Return the name of the cache file of an MS
+
+    The cache directory is (in this order) cache_dir, the environment variable
+    PREFACTOR_METADATA_CACHE, or the directory "metadata_cache" in the current
+    directory (the pipeline runs its steps in its working directory).
+    """
+    path = os.path.abspath(ms.rstrip('/'))
+    if cache_dir is None:
+        cache_dir = os.environ.get('PREFACTOR_METADATA_CACHE',
+                                   os.path.join(os.getcwd(), 'metadata_cache'))
+    key = hashlib.md5(path.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, os.path.basename(path)+'_'+key+'.json')
+
+
+def _write_cache_file(cache_file, entry):
+    """
+    Write a cache entry, or nothing if the cache directory is not writable
+
+    The entry is written to a temporary file first, so that concurrent jobs
+    never see a partial cache file.
+    """
+    cache_dir = os.path.dirname(cache_file)
+    tmpname = None
+    try:
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # already there (e.g. made by a concurrent job) or not writable
+            if not os.path.isdir(cache_dir):
+                raise
+        fd, tmpname = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.rename(tmpname, cache_file)
+    except (IOError, OSError):
+        # no write access: work without cache
+        if tmpname is not None and os.path.exists(tmpname):
+            try:
+                os.remove(tmpname)
+            except OSError:
+                pass
+
+
+def get_ms_metadata(ms, cache_dir=None):
+    """
+    Return the metadata of an MS, from the cache if possible
+
+    Parameters
+    ----------
+    ms : str
+        Filename of the MS
+    cache_dir : str, optional
+        Directory of the cache files (see _cache_filename() for the default)
+
+    Returns
+    -------
+    metadata : dict
+        Metadata of the MS with the keys:
+            nrows, first_time, interval (of the first row of the main table),
+            last_time (of the last row of the main table), first_slot_rows
+            (number of rows of the first time slot),
+            ref_freq, chan_freq, chan_width, nchan, total_bandwidth,
+            time_range, target_name (OBSERVATION), antenna_names,
+            antenna_positions, dish_diameter (ANTENNA), phase_dir [ra, dec]
+            and field_name (FIELD)
+
+    """
+    ms = ms.rstrip('/')
+    path = os.path.abspath(ms)
+    mtime = _ms_mtime(ms)
+    cache_file = _cache_filename(ms, cache_dir)
+
+    metadata = None
+    try:
+        with open(cache_file, 'r') as f:
+            entry = json.load(f)
+        if (entry['version'] == cache_version and entry['path'] == path and
+                entry['mtime'] == mtime):
+            metadata = entry['metadata']
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    if metadata is None:
+        metadata = _read_ms_metadata(ms)
+        entry = {'version': cache_version, 'path': path, 'mtime': mtime,
+                 'metadata': metadata}
+        _write_cache_file(cache_file, entry)
+
+    metadata = dict(metadata)
+    for key in array_keys:
+        if metadata.get(key) is not None:
+            metadata[key] = np.array(metadata[key])
+    return metadata
+
+
+def get_unique_times(ms, cache_dir=None):
+    """
+    Return the sorted unique time stamps of an MS
+
+    If the time stamps are regular, i.e., the first and last time stamps agree
+    with the TIME_RANGE of the observation and the INTERVAL and the number of
+    rows is that of the first time slot times the number of time slots (as for
+    all MSs written by NDPPP), they follow from the (cached) metadata without
+    reading the main table. Otherwise the TIME column is read with a stride of
+    the number of rows of the first time slot (assuming that no time slot has
+    fewer rows).
+
+    Parameters
+    ----------
+    ms : str
+        Filename of the MS
+    cache_dir : str, optional
+        Directory of the cache files (see _cache_filename() for the default)
+
+    Returns
+    -------
+    times : array
+        Unique time stamps in MJD seconds
+    """
+    metadata = get_ms_metadata(ms, cache_dir)
+    if metadata['nrows'] == 0:
+        return np.array([])
+
+    interval = metadata['interval']
+    time_range = metadata['time_range']
+    if interval > 0:
+        ntimes = int(round((time_range[1] - time_range[0]) / interval))
+        times = time_range[0] + interval * (np.arange(ntimes) + 0.5)
+        tolerance = 0.01 * interval
+        if (ntimes > 0 and metadata['nrows'] == metadata['first_slot_rows'] * ntimes and
+                abs(times[0] - metadata['first_time']) < tolerance and
+                abs(times[-1] - metadata['last_time']) < tolerance):
+            return times
+
+    try:
+        import casacore.tables as pt
+    except ImportError:
+        import pyrap.tables as pt
+    t = pt.table(ms.rstrip('/'), ack=False)
+    stride = max(1, metadata['first_slot_rows'])
+    times = np.unique(np.append(t.getcol('TIME', 0, -1, stride),
+                                metadata['last_time']))
+    t.close()
+    return times
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Print the (cached) metadata of MSs.')
+    parser.add_argument('ms_files', nargs='+', help='list of MS files')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='Directory of the cache files (default: metadata_cache in the current directory)')
+    args = parser.parse_args()
+
+    for ms in args.ms_files:
+        print(ms)
+        for key, value in sorted(get_ms_metadata(ms, args.cache_dir).items()):
+            print('    {0}: {1}'.format(key, value))
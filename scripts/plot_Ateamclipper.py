@@ -16,17 +16,25 @@ import matplotlib
 import matplotlib.pyplot as plt
 import numpy
 
-def main(txtfile = 'Ateamclipper.txt', outfile = 'Ateamclipper.png'):
-
-    frac_list_xx = []
-    frac_list_yy = []
-    freq_list    = []
-    with open(txtfile, 'r') as infile:
-        for line in infile:
-            freq_list.append(float(line.split()[0]))
-            frac_list_xx.append(float(line.split()[1]))
-            frac_list_yy.append(float(line.split()[2]))
-    
+def main(infile = 'Ateamclipper.npz', outfile = 'Ateamclipper.png'):
+
+    if infile.endswith('.npz'):
+        # table written by merge_Ateamclipper.py
+        with numpy.load(infile) as table:
+            freq_list    = table['freq']
+            frac_list_xx = table['clipped_xx']
+            frac_list_yy = table['clipped_yy']
+    else:
+        # text file of older versions of Ateamclipper.py
+        frac_list_xx = []
+        frac_list_yy = []
+        freq_list    = []
+        with open(infile, 'r') as txtfile:
+            for line in txtfile:
+                freq_list.append(float(line.split()[0]))
+                frac_list_xx.append(float(line.split()[1]))
+                frac_list_yy.append(float(line.split()[2]))
+
     # Plot the amount of clipped data vs. frequency potentially contaminated by the A-team
     plt.scatter(numpy.array(freq_list) / 1e6, numpy.array(frac_list_xx), marker = '.', s = 10)
     plt.xlabel('frequency [MHz]')
@@ -37,13 +45,13 @@ def main(txtfile = 'Ateamclipper.txt', outfile = 'Ateamclipper.png'):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Adds phases and amplitudes to any missing station if they appear in an h5parm, but not in a particular soltab.')
 
-    parser.add_argument('txtfile', type=str,
-                        help='Input text file containing frequency and flag fraction of the XX and YY polarization.')
+    parser.add_argument('infile', type=str,
+                        help='Input table (written by merge_Ateamclipper.py) or text file containing frequency and flag fraction of the XX and YY polarization.')
     parser.add_argument('outfile', type=str,
-                        help='Input text file containing frequency and flag fraction of the XX and YY polarization.')
+                        help='Output plot.')
 
 
     args = parser.parse_args()
 
-    main(txtfile = args.txtfile, outfile = args.outfile)
+    main(infile = args.infile, outfile = args.outfile)
 
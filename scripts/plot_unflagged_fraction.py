@@ -9,7 +9,8 @@ mpl.use('Agg')
 import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
-import casacore.tables as pt
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from ms_metadata import get_ms_metadata
 from matplotlib import cm
 
 
@@ -43,10 +44,8 @@ def main(ms_list, frac_list, outfile='unflagged_fraction.png'):
     # Get frequencies
     freq_list = []
     for ms in ms_list:
-        # open the main table and print some info about the MS
-        t = pt.table(ms, readonly=True, ack=False)
-        tfreq = pt.table(t.getkeyword('SPECTRAL_WINDOW'),readonly=True,ack=False)
-        ref_freq = tfreq.getcol('REF_FREQUENCY',nrow=1)[0]
+        # reference frequency from the (cached) metadata of the MS
+        ref_freq = get_ms_metadata(ms)['ref_freq']
         freq_list.append(ref_freq)
     freq_list = np.array(freq_list) / 1e6  # MHz
 
@@ -4,9 +4,12 @@ Script to sort a list of MSs by into frequency groups by time-stamp
 """
 import pyrap.tables as pt
 import sys, os
+import multiprocessing
 import numpy as np
 from lofarpipe.support.data_map import DataMap
 from lofarpipe.support.data_map import DataProduct
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from ms_metadata import get_ms_metadata
 
 def _calc_edge_chans(inmap, numch, edgeFactor=32):
     """
@@ -29,6 +32,61 @@ def _calc_edge_chans(inmap, numch, edgeFactor=32):
         print '_calc_edge_chans: flaglist:', str(flaglist).replace(' ','')
     return outmap
 
+def _get_ms_info(ms):
+    """
+    Get the start time and the frequency info of an MS
+
+    The start time is taken from the first row of the main table if it agrees
+    with the start of OBSERVATION::TIME_RANGE, so that the TIME column only
+    needs to be scanned if the two disagree.
+
+    ms - Filename of the MS
+
+    Returns a dict with the keys 'timestamp', 'freq', 'bandwidth', 'nchans' and 'chwidth'
+    """
+    metadata = get_ms_metadata(ms)
+    first_time = metadata['first_time']
+    if (first_time is not None and
+        abs(first_time - metadata['interval']/2. - metadata['time_range'][0]) <= metadata['interval']/2.):
+        timestamp = int(round(first_time))
+    else:
+        # use the slower but more reliable way:
+        obstable = pt.table(ms, ack=False)
+        timestamp = int(round(np.min(obstable.getcol('TIME'))))
+        obstable.close()
+    return {'timestamp': timestamp, 'freq': metadata['ref_freq'],
+            'bandwidth': metadata['total_bandwidth'], 'nchans': metadata['nchan'],
+            'chwidth': metadata['chan_width'][0]}
+
+def _assign_slots(freqs, slots_low, freq_width):
+    """
+    Assigns files to the frequency-slots of the groups.
+
+    freqs      - Sorted array with the frequencies of the files
+    slots_low  - Array with the lower frequencies of all slots (of all groups in order)
+    freq_width - Width of one slot
+
+    Returns an array with the index of the slot for each file, or -1 for files that
+    could not be assigned. Files are assigned in order: each file goes into the first
+    slot after the slot of the previous file that contains its frequency. If a file
+    doesn't fit into any such slot, then this file and all following files remain
+    unassigned.
+    """
+    slots = np.zeros(len(freqs), dtype=int) - 1
+    # the slots are (nearly) sorted, so only a few slots around the position from
+    # searchsorted can contain a frequency
+    candidates = np.searchsorted(np.maximum.accumulate(slots_low), freqs)
+    last_slot = -1
+    for fileIdx, freq in enumerate(freqs):
+        for slotIdx in xrange(max(candidates[fileIdx]-3, last_slot+1), min(candidates[fileIdx]+2, len(slots_low))):
+            if freq > slots_low[slotIdx] and freq < slots_low[slotIdx]+freq_width:
+                slots[fileIdx] = slotIdx
+                last_slot = slotIdx
+                break
+        else:
+            break
+    return slots
+
 def input2bool(invar):
     if invar == None:
         return None
@@ -64,7 +122,7 @@ def input2int(invar):
 
     
 def main(ms_input, filename=None, mapfile_dir=None, numSB=-1, hosts=None, NDPPPfill=True, target_path=None, stepname=None,
-         mergeLastGroup=False, truncateLastSBs=True, firstSB=None):
+         mergeLastGroup=False, truncateLastSBs=True, firstSB=None, nthreads=8):
     """
     Check a list of MS files for missing frequencies
 
@@ -107,6 +165,11 @@ def main(ms_input, filename=None, mapfile_dir=None, numSB=-1, hosts=None, NDPPPf
         If set, then reference the grouping of files to this station-subband. As if a file 
         with this station-subband would be included in the input files.
         (For HBA-low, i.e. 0 -> 100MHz, 55 -> 110.74MHz, 512 -> 200MHz)
+    nthreads : int, optional
+        Number of processes that read the metadata of the MSs in parallel.
+        (Reading the metadata is limited by the latency of the filesystem,
+        so this can be larger than the number of cores.)
+        default = 8
 
     Returns
     -------
@@ -120,6 +183,7 @@ def main(ms_input, filename=None, mapfile_dir=None, numSB=-1, hosts=None, NDPPPf
     truncateLastSBs = input2bool(truncateLastSBs)
     firstSB = input2int(firstSB)
     numSB = int(numSB)
+    nthreads = input2int(nthreads)
 
     if not filename or not mapfile_dir:
         raise ValueError('sort_times_into_freqGroups: filename and mapfile_dir are needed!')
@@ -152,17 +216,22 @@ def main(ms_input, filename=None, mapfile_dir=None, numSB=-1, hosts=None, NDPPPf
     numhosts = len(hosts)
     print "sort_times_into_freqGroups: Working on",len(ms_list),"files (including flagged files)."
 
+    # work only on files selected by a previous step
+    ms_files = [ms for ms in ms_list if ms.lower() != 'none']
+    if nthreads > 1 and len(ms_files) > 1:
+        pool = multiprocessing.Pool(min(nthreads, len(ms_files)))
+        ms_info = dict(zip(ms_files, pool.map(_get_ms_info, ms_files)))
+        pool.close()
+        pool.join()
+    else:
+        ms_info = dict(zip(ms_files, map(_get_ms_info, ms_files)))
+
     time_groups = {}
     # sort by time
     for i, ms in enumerate(ms_list):
         # work only on files selected by a previous step
         if ms.lower() != 'none':
-            # use the slower but more reliable way:
-            obstable = pt.table(ms, ack=False)
-            timestamp = int(round(np.min(obstable.getcol('TIME'))))
-            #obstable = pt.table(ms+'::OBSERVATION', ack=False)
-            #timestamp = int(round(obstable.col('TIME_RANGE')[0][0]))
-            obstable.close()
+            timestamp = ms_info[ms]['timestamp']
             if timestamp in time_groups:
                 time_groups[timestamp]['files'].append(ms)
             else:
@@ -178,21 +247,20 @@ def main(ms_input, filename=None, mapfile_dir=None, numSB=-1, hosts=None, NDPPPf
         freqs = []
         for ms in time_groups[time]['files']:
             # Get the frequency info
-            sw = pt.table(ms+'::SPECTRAL_WINDOW', ack=False)
-            freq = sw.col('REF_FREQUENCY')[0]            
+            sw = ms_info[ms]
+            freq = sw['freq']
             if first:
-                file_bandwidth = sw.col('TOTAL_BANDWIDTH')[0]
-                nchans = sw.col('CHAN_WIDTH')[0].shape[0]
-                chwidth = sw.col('CHAN_WIDTH')[0][0]
+                file_bandwidth = sw['bandwidth']
+                nchans = sw['nchans']
+                chwidth = sw['chwidth']
                 freqset = set([freq])
                 first = False
             else:
-                assert file_bandwidth == sw.col('TOTAL_BANDWIDTH')[0]
-                assert nchans == sw.col('CHAN_WIDTH')[0].shape[0]
-                assert chwidth == sw.col('CHAN_WIDTH')[0][0]
+                assert file_bandwidth == sw['bandwidth']
+                assert nchans == sw['nchans']
+                assert chwidth == sw['chwidth']
                 freqset.add(freq)
             freqs.append(freq)
-            sw.close()
         time_groups[time]['freq_names'] = zip(freqs,time_groups[time]['files'])
         time_groups[time]['freq_names'].sort(key=lambda pair: pair[0])
         #time_groups[time]['files'] = [name for (freq,name) in freq_names]
@@ -252,25 +320,33 @@ def main(ms_input, filename=None, mapfile_dir=None, numSB=-1, hosts=None, NDPPPf
     
     print "sort_times_into_freqGroups: Will create",ngroups,"group(s) with",numSB,"file(s) each."
 
+    # lower frequencies of the file-slots of all groups, these are the same for all time-groups
+    slots_low = [np.arange(freqborders[groupIdx],freqborders[groupIdx+1],freq_width) for groupIdx in xrange(ngroups)]
+    nslots = np.array([len(group_slots) for group_slots in slots_low])
+    slot_group = np.repeat(np.arange(ngroups), nslots)
+    slot_pos = np.arange(len(slot_group)) - np.repeat(np.cumsum(nslots)-nslots, nslots)
+    slots_low = np.concatenate(slots_low)
+
     hostID = 0
     for time in timestamps:
-        (freq,fname) = time_groups[time]['freq_names'].pop(0)
+        freqs = np.array([freq for (freq,fname) in time_groups[time]['freq_names']])
+        fnames = [fname for (freq,fname) in time_groups[time]['freq_names']]
+        slots = _assign_slots(freqs, slots_low, freq_width)
+        assigned = slots >= 0
+        # dense table of file-names: one row per group, one column per slot
+        filetable = np.empty((ngroups, np.max(nslots)), dtype=object)
+        filetable[:] = 'dummy.ms'
+        used = np.zeros((ngroups, np.max(nslots)), dtype=bool)
+        filetable[slot_group[slots[assigned]], slot_pos[slots[assigned]]] = [fname for (fname,isused) in zip(fnames,assigned) if isused]
+        used[slot_group[slots[assigned]], slot_pos[slots[assigned]]] = True
+        group_used = np.any(used, axis=1)
         for groupIdx in xrange(ngroups):
-            files = []
-            skip_this = True
-            filefreqs_low = np.arange(freqborders[groupIdx],freqborders[groupIdx+1],freq_width)
-            for lower_freq in filefreqs_low:
-                if freq > lower_freq and freq < lower_freq+freq_width:
-                    assert freq!=1e12
-                    files.append(fname)
-                    if len(time_groups[time]['freq_names'])>0:
-                        (freq,fname) = time_groups[time]['freq_names'].pop(0)
-                    else:
-                        (freq,fname) = (1e12,'This_shouldn\'t_show_up')
-                    skip_this = False
-                elif NDPPPfill:
-                    files.append('dummy.ms')
+            skip_this = not group_used[groupIdx]
             if not skip_this:
+                if NDPPPfill:
+                    files = filetable[groupIdx,:nslots[groupIdx]].tolist()
+                else:
+                    files = filetable[groupIdx][used[groupIdx]].tolist()
                 filemap.append(MultiDataProduct(hosts[hostID%numhosts], files, skip_this))
                 freqID = int((freqborders[groupIdx]+freqborders[groupIdx+1])/2e6)
                 groupname = time_groups[time]['basename']+'_%Xt_%dMHz.ms'%(time,freqID)
@@ -279,9 +355,7 @@ def main(ms_input, filename=None, mapfile_dir=None, numSB=-1, hosts=None, NDPPPf
                 if type(target_path) is str:
                     groupname = os.path.join(target_path,os.path.basename(groupname))
                 groupmap.append(DataProduct(hosts[hostID%numhosts],groupname, skip_this))
-        orphan_files = len(time_groups[time]['freq_names'])
-        if freq < 1e12:
-            orphan_files += 1
+        orphan_files = len(fnames) - np.sum(assigned)
         if orphan_files > 0:
             print "sort_times_into_freqGroups: Had %d unassigned files in time-group %xt."%(orphan_files, time)
     filemapname = os.path.join(mapfile_dir, filename)
@@ -394,6 +468,7 @@ if __name__ == '__main__':
     opt.add_option('-d', '--decimate', help='Remove every 10th file (after randomization if that is done). (default=False)', action='store_true', default=False)
     opt.add_option('-n', '--numbands', help='Number of how many files should be grouped together in frequency. (default=all files in one group)', type='int', default=-1)
     opt.add_option('-f', '--filename', help='Name for the mapfiles to write. (default=\"test.mapfile\")', type='string', default='test.mapfile')
+    opt.add_option('-j', '--nthreads', help='Number of processes that read the metadata of the MSs. (default=8)', type='int', default=8)
 
     (options, args) = opt.parse_args()
 
@@ -410,7 +485,8 @@ if __name__ == '__main__':
         for i in range((len(inMSs)-1),-1,-10):
             inMSs.pop(i)
 
-    ergdict = main(inMSs, options.filename, '.', numSB=options.numbands, hosts=None, NDPPPfill=True)
+    ergdict = main(inMSs, options.filename, '.', numSB=options.numbands, hosts=None, NDPPPfill=True,
+                   nthreads=options.nthreads)
 
     groupmap = DataMap.load(ergdict['groupmapfile'])
     filemap = MultiDataMap.load(ergdict['mapfile'])